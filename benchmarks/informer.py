@@ -0,0 +1,93 @@
+"""Pod status tracking: the per phase lists status() used to keep against
+the PodStore delta counters of the informer, on a synthetic watch stream of
+pods going from Pending to Pulling, Running and Succeeded.
+
+    python benchmarks/informer.py --pods 20000
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from higgsdemo.informer import PHASES, PodInformer
+
+
+def _pod(name, phase, pulling, rv):
+    state = {'running': {'startedAt': '2024-01-01T00:00:00Z'}} if pulling else {}
+    return {'metadata': {'name': name, 'resourceVersion': str(rv)},
+            'status': {'phase': phase,
+                       'initContainerStatuses': [{'name': 'prepull', 'state': state}]}}
+
+
+def events(pods, seed=1):
+    names = ['job-%06d' % i for i in range(pods)]
+    steps = [('ADDED', 'Pending', False)] + [
+        ('MODIFIED', phase, pulling) for phase, pulling in
+        (('Pending', True), ('Running', False), ('Succeeded', False))]
+    rnd = random.Random(seed)
+    result = []
+    for kind, phase, pulling in steps:
+        order = list(names)
+        if kind != 'ADDED':
+            rnd.shuffle(order)
+        for name in order:
+            pod = _pod(name, phase, pulling, len(result))
+            result.append({'type': kind, 'raw_object': pod})
+    return result
+
+
+def lists(evs):
+    # what status() did for every event before the informer
+    pods = dict((p, []) for p in PHASES)
+    for event in evs:
+        pod = event['raw_object']
+        name = pod['metadata']['name']
+        prepull = pod['status']['initContainerStatuses'][0]['state'].get('running')
+        for p in pods.keys():
+            try:
+                pods[p].remove(name)
+            except ValueError:
+                pass
+        if event['type'] != 'DELETED':
+            pods['Pulling' if prepull else pod['status']['phase']].append(name)
+        result = dict((p, len(v)) for p, v in pods.items())
+    return result
+
+
+def store(evs):
+    informer = PodInformer(None, 'default')
+    results = []
+    informer.add_handler(lambda s: results.append(s.result()))
+    for event in evs:
+        informer._handle(event)
+    return results[-1]
+
+
+def measure(fn, evs):
+    start = time.process_time()
+    result = fn(evs)
+    return len(evs) / (time.process_time() - start), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pods', type=int, default=20000)
+    parser.add_argument('--list-events', type=int, default=None,
+                        help='events given to the per phase lists, which are '
+                             'quadratic (default: as many as pods)')
+    args = parser.parse_args()
+
+    evs = events(args.pods)
+    n = args.list_events or args.pods
+    rate, result = measure(store, evs)
+    print('%d events over %d pods' % (len(evs), args.pods))
+    print('store: %.0f events/s, %s' % (rate, result))
+    rate, _ = measure(lists, evs[:n])
+    print('lists: %.0f events/s over the first %d events' % (rate, n))
+
+
+if __name__ == '__main__':
+    main()
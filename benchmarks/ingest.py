@@ -0,0 +1,91 @@
+"""Cold start of the notebook plot: a fresh Accumulator given every result of
+a run as redis returns them, added one document at a time against add_many,
+with the json module and with orjson when it is installed.
+
+    python benchmarks/ingest.py --results 20000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'notebook', 'cms-higgs-plot'))
+
+import numpy as np
+
+import plotting.higgsplot as hp
+
+
+def documents(results, seed=1):
+    # (key, value) bytes pairs shaped like the redis data hash
+    rnd = random.Random(seed)
+    items = []
+    for i in range(results):
+        name = rnd.choice(hp.samples)
+        d = {'samplename': name, 'processed': rnd.randint(1000, 50000), 'lumi': None}
+        for pick in hp.sampledata[name]['pickup']:
+            d[pick] = [float(rnd.randint(0, 3)) for _ in range(hp.NBINS)]
+        if 'cms_run' in name:
+            d['lumi'] = {'stream': rnd.choice(hp.streams), 'value': rnd.uniform(1e3, 1e5)}
+        items.append((('/tmp/outputs/f%06d.root' % i).encode('utf-8'),
+                      json.dumps(d).encode('utf-8')))
+    return items
+
+
+def per_document(items):
+    # what Accumulator.update did before add_many
+    acc = hp.Accumulator()
+    for key, raw in items:
+        if key not in acc.seen:
+            acc.seen.add(key)
+            acc.add(json.loads(raw))
+    return acc
+
+
+def bulk(items):
+    acc = hp.Accumulator()
+    acc.update(items)
+    return acc
+
+
+def best(fn, items, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.time()
+        result = fn(items)
+        times.append(time.time() - start)
+    return min(times), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--results', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    items = documents(args.results)
+    print('%d results, best of %d' % (len(items), args.repeat))
+    t, reference = best(per_document, items, args.repeat)
+    print('per document:     %.2fs' % t)
+
+    parsers = [('json', json.loads)]
+    if hp.loads is not json.loads:
+        parsers.append(('orjson', hp.loads))
+    fast = hp.loads
+    try:
+        for name, loads in parsers:
+            hp.loads = loads
+            t, acc = best(bulk, items, args.repeat)
+            same = (np.allclose(acc.counts, reference.counts) and
+                    np.allclose(acc.lumi, reference.lumi) and
+                    (acc.files == reference.files).all())
+            print('add_many, %-7s %.2fs%s' % (name + ':', t, '' if same else ' (differs)'))
+    finally:
+        hp.loads = fast
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,135 @@
+"""Listing the pods of a run: deserializing the list into client models
+against json.loads of the raw response, on a list of running job pods shaped
+like the ones of job-template.yaml. Both go through list_namespaced_pod of
+the client, with the http response stubbed.
+
+    python benchmarks/list_json.py --pods 5000
+"""
+import argparse
+import copy
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+import urllib3
+from kubernetes import client
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from higgsdemo.informer import pod_phase
+
+T = '2024-01-01T00:00:00Z'
+
+
+def _container(name, command, envs):
+    return {'name': name, 'image': 'eu.gcr.io/it-atlas-cern/cms-higgs-4l-full',
+            'command': ['bash', '-c', command],
+            'env': [{'name': 'E%d' % i, 'value': 'v' * 30} for i in range(envs)],
+            'resources': dict((k, {'cpu': '900m', 'memory': '6Gi'})
+                              for k in ('limits', 'requests')),
+            'volumeMounts': [{'name': 'inputs', 'mountPath': '/inputs'},
+                             {'name': 'runjob', 'mountPath': command, 'subPath': command[1:]}],
+            'terminationMessagePath': '/dev/termination-log', 'imagePullPolicy': 'Always'}
+
+
+def _status(name, state):
+    return {'name': name, 'state': state, 'ready': True, 'restartCount': 0, 'image': 'w',
+            'imageID': 'sha256:abc', 'containerID': 'containerd://abc', 'started': True}
+
+
+POD = {
+    'metadata': {
+        'name': 'x', 'namespace': 'default', 'uid': '8c1e', 'resourceVersion': '123',
+        'creationTimestamp': T,
+        'labels': {'controller-uid': '8c1e', 'job-name': 'x', 'higgsdemo/run': 'run6'},
+        'ownerReferences': [{'apiVersion': 'batch/v1', 'kind': 'Job', 'name': 'x',
+                             'uid': '8c1e', 'controller': True, 'blockOwnerDeletion': True}],
+        'managedFields': [{'manager': 'kube-controller-manager', 'operation': 'Update',
+                           'apiVersion': 'v1', 'time': T, 'fieldsType': 'FieldsV1',
+                           'fieldsV1': {'f:metadata': {'f:labels': {'.': {}, 'f:job-name': {}}},
+                                        'f:spec': {'f:containers': {}}}}]},
+    'spec': {
+        'volumes': [{'name': 'runjob', 'configMap': {'name': 'runjob', 'defaultMode': 493}},
+                    {'name': 'getfile', 'configMap': {'name': 'getfile', 'defaultMode': 493}},
+                    {'name': 'inputs', 'emptyDir': {'medium': 'Memory'}}],
+        'initContainers': [_container('prepull', '/getfile.sh', 12)],
+        'containers': [_container('cmsrun', '/runjob.sh', 20),
+                       _container('prefetch', '/getfile.sh', 20)],
+        'restartPolicy': 'Never', 'terminationGracePeriodSeconds': 5,
+        'dnsPolicy': 'ClusterFirst', 'nodeName': 'gke-node-1',
+        'schedulerName': 'default-scheduler',
+        'tolerations': [{'key': 'node.kubernetes.io/not-ready', 'operator': 'Exists',
+                         'effect': 'NoExecute', 'tolerationSeconds': 300}]},
+    'status': {
+        'phase': 'Running', 'hostIP': '10.0.0.1', 'podIP': '10.1.0.1', 'startTime': T,
+        'qosClass': 'Guaranteed',
+        'conditions': [{'type': t, 'status': 'True', 'lastTransitionTime': T}
+                       for t in ('Initialized', 'Ready', 'ContainersReady', 'PodScheduled')],
+        'initContainerStatuses': [_status('prepull', {'terminated': {
+            'exitCode': 0, 'reason': 'Completed', 'startedAt': T, 'finishedAt': T}})],
+        'containerStatuses': [_status(n, {'running': {'startedAt': T}})
+                              for n in ('cmsrun', 'prefetch')]}}
+
+
+def pod_list(pods):
+    items = []
+    for i in range(pods):
+        pod = copy.deepcopy(POD)
+        pod['metadata']['name'] = 'job-%05d' % i
+        items.append(pod)
+    return json.dumps({'kind': 'PodList', 'apiVersion': 'v1',
+                       'metadata': {'resourceVersion': '999'}, 'items': items}).encode('utf-8')
+
+
+class _Pool(object):
+    # stands in for the urllib3 pool manager of the rest client
+
+    def __init__(self, data):
+        self.data = data
+
+    def request(self, *args, **kwargs):
+        return urllib3.HTTPResponse(body=self.data, status=200, preload_content=True,
+                                    headers={'Content-Type': 'application/json'})
+
+
+def _core(data):
+    api = client.ApiClient()
+    api.rest_client.pool_manager = _Pool(data)
+    return client.CoreV1Api(api)
+
+
+def models(data):
+    # what a list without _preload_content=False costs, plus the to_dict the
+    # old code called on it
+    result = _core(data).list_namespaced_pod('default').to_dict()
+    return dict((p['metadata']['name'], p['status']['phase']) for p in result['items'])
+
+
+def raw(data):
+    resp = _core(data).list_namespaced_pod('default', _preload_content=False)
+    result = json.loads(resp.data)
+    return dict((p['metadata']['name'], pod_phase(p)) for p in result['items'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--pods', type=int, default=5000)
+    args = parser.parse_args()
+
+    data = pod_list(args.pods)
+    print('list of %d pods, %.1f MB of json' % (args.pods, len(data) / 1e6))
+    for fn in (models, raw):
+        start = time.process_time()
+        fn(data)
+        cpu = time.process_time() - start
+        tracemalloc.start()
+        fn(data)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('%s: %.2fs of cpu, peak %.0f MB' % (fn.__name__, cpu, peak / 1e6))
+
+
+if __name__ == '__main__':
+    main()
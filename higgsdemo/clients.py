@@ -0,0 +1,53 @@
+import logging
+import socket
+import threading
+
+log = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_clients = {}
+
+
+def _keepalive_options(idle):
+    options = [(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)]
+    for name, value in (('TCP_KEEPIDLE', idle), ('TCP_KEEPINTVL', max(1, idle // 3)),
+                        ('TCP_KEEPCNT', 3)):
+        if hasattr(socket, name):
+            options.append((socket.IPPROTO_TCP, getattr(socket, name), value))
+    return options
+
+
+def _build(context, pool_size, keepalive):
+    from kubernetes import client
+    from kubernetes import config as kube_config
+    from urllib3.connection import HTTPConnection
+
+    configuration = client.Configuration()
+    kube_config.load_kube_config(context=context, client_configuration=configuration)
+    configuration.connection_pool_maxsize = pool_size
+    api_client = client.ApiClient(configuration)
+    pool_kw = api_client.rest_client.pool_manager.connection_pool_kw
+    # wait for a pooled connection instead of opening one that is closed
+    # again right after the request
+    pool_kw['block'] = True
+    if keepalive:
+        pool_kw['socket_options'] = (HTTPConnection.default_socket_options +
+                                     _keepalive_options(keepalive))
+    log.debug('api client for %s with %d connections', context, pool_size)
+    return api_client
+
+
+def api_client(context, pool_size=20, keepalive=30):
+    """Returns the api client of a kubeconfig context, shared by everything
+    in the process talking to that cluster.
+
+    The kubeconfig is parsed and the connection pool created on first use
+    only, so later operations reuse warm connections. keepalive is the idle
+    time in seconds before tcp keep-alive probes start (0 disables them). A
+    client asked for with a larger pool than it has is built again."""
+    with _lock:
+        entry = _clients.get(context)
+        if entry is None or entry[1] < pool_size:
+            entry = (_build(context, pool_size, keepalive), pool_size)
+            _clients[context] = entry
+        return entry[0]
@@ -1,21 +1,12 @@
 import logging
 import higgsdemo.main as demo
+from higgsdemo.controller import Controller
 import json
 import subprocess
 import time
 
-from google.cloud import container_v1
-
 from cliff.command import Command
 from datetime import datetime
-from jupyterlab.labapp import main as jupyterlab_main
-
-
-def parallel_cleanup(args, i):
-    args.cluster = '{0}{1}'.format(args.prefix, i)
-    args.dataset_index = i
-    d = demo._higgs_demo(args)
-    d.cleanup()
 
 
 class Cleanup(Command):
@@ -28,6 +19,9 @@ class Cleanup(Command):
         parser.add_argument('--namespace', dest='namespace',
                             default='default',
                             help='the kube namespace to use')
+        parser.add_argument('--run', dest='run',
+                            default='run6',
+                            help='the name of the demo run to clean up (all runs if empty)')
         parser.add_argument('--limit', dest='limit', type=int,
                             default=200,
                             help='the limit of objects per kube api query')
@@ -40,6 +34,18 @@ class Cleanup(Command):
         parser.add_argument('--prefix', dest='prefix',
                             default='kubecon-demo-',
                             help='the prefix to use when naming clusters')
+        parser.add_argument('--pool-size', dest='pool_size', type=int,
+                            default=None,
+                            help='the max number of api connections kept per cluster '
+                                 '(defaults to --max-inflight)')
+        parser.add_argument('--keepalive', dest='keepalive', type=int,
+                            default=30,
+                            help='the idle seconds before tcp keep-alive probes are sent on '
+                                 'api connections (0 disables them)')
+        parser.add_argument('--global-inflight', dest='global_inflight', type=int,
+                            default=100,
+                            help='the max number of concurrent api requests over all clusters '
+                                 'of the dataset mapping')
         return parser
 
     def take_action(self, parsed_args):
@@ -50,15 +56,11 @@ class Cleanup(Command):
         with open(parsed_args.dataset_mapping, "r") as f:
             datasets = json.load(f)
 
-        import joblib
-        jobs = joblib.Parallel(n_jobs=len(datasets))(joblib.delayed(parallel_cleanup)(parsed_args, i) for i, ds in enumerate(datasets))
-
-
-def parallel_submit(args, i):
-    args.cluster = '{0}{1}'.format(args.prefix, i)
-    args.dataset_index = i
-    d = demo._higgs_demo(args)
-    d.submit()
+        controller = Controller(parsed_args, datasets, parsed_args.global_inflight)
+        try:
+            controller.cleanup()
+        finally:
+            controller.close()
 
 
 class Submit(Command):
@@ -140,9 +142,87 @@ class Submit(Command):
         parser.add_argument('--cluster', dest='cluster',
                             default=None,
                             help='the cluster context to be used')
+        parser.add_argument('--max-inflight', dest='max_inflight', type=int,
+                            default=20,
+                            help='the max number of concurrent job create requests per cluster')
+        parser.add_argument('--max-retries', dest='max_retries', type=int,
+                            default=8,
+                            help='the max retries of a job create throttled by the api server')
+        parser.add_argument('--indexed', dest='indexed', action='store_true',
+                            default=False,
+                            help='submit one indexed job per dataset instead of one job per file '
+                                 '(requires kubernetes 1.22 or later)')
+        parser.add_argument('--max-completions', dest='max_completions', type=int,
+                            default=2000,
+                            help='the max number of files per indexed job')
+        parser.add_argument('--files-per-job', dest='files_per_job', type=int,
+                            default=1,
+                            help='the number of files of the same dataset processed by one pod')
+        parser.add_argument('--prefetch-window', dest='prefetch_window', type=int,
+                            default=2,
+                            help='the max number of input files held in a pod while the next '
+                                 'ones are downloaded (0 downloads all files before running)')
+        parser.add_argument('--prefetch-max-mb', dest='prefetch_max_mb', type=int,
+                            default=3000,
+                            help='the max size of the input files held in a pod while the next '
+                                 'ones are downloaded, in mb (0 for no limit)')
+        parser.add_argument('--download-threads', dest='download_threads', type=int,
+                            default=8,
+                            help='the number of parallel range requests per input file download')
+        parser.add_argument('--storage-region', dest='storage_region',
+                            default='auto',
+                            help='the region used to sign storage requests (us-east-1 for minio)')
+        parser.add_argument('--input-cache', dest='input_cache',
+                            default='',
+                            help='the node path of a local input file cache, '
+                                 'e.g. /mnt/disks/ssd0/higgs-cache (disabled if empty)')
+        parser.add_argument('--input-cache-max-mb', dest='input_cache_max_mb', type=int,
+                            default=50000,
+                            help='the max size of the input cache on each node in mb')
+        parser.add_argument('--schedule', dest='schedule', action='store_true',
+                            default=False,
+                            help='hand out the files of all mapping entries from one queue to '
+                                 'the clusters with free capacity, instead of one entry per cluster')
+        parser.add_argument('--file-costs', dest='file_costs',
+                            default=None,
+                            help='a json file mapping input file names to their estimated cost '
+                                 '(e.g. size or number of events), used with --schedule')
+        parser.add_argument('--poll-interval', dest='poll_interval', type=int,
+                            default=10,
+                            help='the seconds between cluster capacity checks with --schedule')
+        parser.add_argument('--pool-size', dest='pool_size', type=int,
+                            default=None,
+                            help='the max number of api connections kept per cluster '
+                                 '(defaults to --max-inflight)')
+        parser.add_argument('--keepalive', dest='keepalive', type=int,
+                            default=30,
+                            help='the idle seconds before tcp keep-alive probes are sent on '
+                                 'api connections (0 disables them)')
+        parser.add_argument('--global-inflight', dest='global_inflight', type=int,
+                            default=100,
+                            help='the max number of concurrent api requests over all clusters '
+                                 'of the dataset mapping')
+        parser.add_argument('--plan', dest='plan',
+                            default=None,
+                            help='the plan file of the run made by the plan command')
+        parser.add_argument('--resume', dest='resume', action='store_true',
+                            default=False,
+                            help='only submit the files without a result in redis, e.g. '
+                                 'after an interrupted submit')
+        parser.add_argument('--retry', dest='retry', action='store_true',
+                            default=False,
+                            help='submit the jobs with a backoff limit of 0, for the retry '
+                                 'command to resubmit the failed ones')
         return parser
 
     def take_action(self, parsed_args):
+        if parsed_args.retry and parsed_args.indexed:
+            # the retry command leaves indexed jobs to kubernetes
+            raise RuntimeError('--retry does not support --indexed')
+        if parsed_args.resume and parsed_args.indexed:
+            # the remaining files would be renumbered into chunks whose jobs
+            # and file lists exist already
+            raise RuntimeError('--resume does not support --indexed')
         if not parsed_args.dataset_mapping:
             hd = demo._higgs_demo(parsed_args)
             return hd.submit()
@@ -150,10 +230,49 @@ class Submit(Command):
         with open(parsed_args.dataset_mapping, "r") as f:
             datasets = json.load(f)
 
-        import joblib
-        jobs = joblib.Parallel(n_jobs=len(datasets))(joblib.delayed(parallel_submit)(parsed_args, i) for i, ds in enumerate(datasets))
+        if parsed_args.schedule and parsed_args.indexed:
+            raise RuntimeError('--schedule does not support --indexed')
+
+        controller = Controller(parsed_args, datasets, parsed_args.global_inflight)
+        try:
+            if parsed_args.schedule:
+                from higgsdemo.scheduler import Scheduler
+                return Scheduler(controller.demos, parsed_args.file_costs,
+                                 parsed_args.poll_interval).run()
+            controller.submit()
+        finally:
+            controller.close()
         
 
+class Plan(Command):
+    "resolve the dataset files, lumi data and job names of a run into a plan file"
+
+    log = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        parser = super(Plan, self).get_parser(prog_name)
+        parser.add_argument('--dataset-pattern', dest='dataset_pattern',
+                            default=None,
+                            help='the pattern of datasets to process')
+        parser.add_argument('--dataset-mapping', dest='dataset_mapping',
+                            default=None,
+                            help='the mapping file of dataset files to process')
+        parser.add_argument('--storage-type', dest='storage_type',
+                            default='gs',
+                            help='the type of storage (s3 or gcs)')
+        parser.add_argument('--bucket', dest='bucket',
+                            default='higgs-demo',
+                            help='the name of the bucket holding the data')
+        parser.add_argument('--output', dest='output',
+                            default='plan.json',
+                            help='the plan file to write')
+        return parser
+
+    def take_action(self, parsed_args):
+        hd = demo._higgs_demo(parsed_args)
+        hd.write_plan(parsed_args.output)
+
+
 class Watch(Command):
     "watch status of the higgs demo deployment in the currently configured cluster"
 
@@ -164,9 +283,15 @@ class Watch(Command):
         parser.add_argument('--namespace', dest='namespace',
                             default='default',
                             help='the kube namespace to use')
+        parser.add_argument('--run', dest='run',
+                            default='run6',
+                            help='the name of the demo run to watch')
         parser.add_argument('--cluster', dest='cluster',
                             default=None,
                             help='the cluster context to be used')
+        parser.add_argument('--plan', dest='plan',
+                            default=None,
+                            help='the plan file of the run made by the plan command')
         return parser
 
     def take_action(self, parsed_args):
@@ -178,11 +303,49 @@ class Watch(Command):
         hd.status(fn=fn)
 
 
-def parallel_prepare(args, i):
-    args.cluster = '{0}{1}'.format(args.prefix, i)
-    d = demo._higgs_demo(args)
-    d.prepare()
-        
+class Retry(Command):
+    "resubmit failed jobs of the higgs demo adjusted to why they failed"
+
+    log = logging.getLogger(__name__)
+
+    def get_parser(self, prog_name):
+        parser = super(Retry, self).get_parser(prog_name)
+        parser.add_argument('--namespace', dest='namespace',
+                            default='default',
+                            help='the kube namespace to use')
+        parser.add_argument('--run', dest='run',
+                            default='run6',
+                            help='the name of the demo run to retry failed jobs of')
+        parser.add_argument('--cluster', dest='cluster',
+                            default=None,
+                            help='the cluster context to be used')
+        parser.add_argument('--max-attempts', dest='max_attempts', type=int,
+                            default=4,
+                            help='the max number of times a file is run before it is quarantined')
+        parser.add_argument('--memory-factor', dest='memory_factor', type=float,
+                            default=1.5,
+                            help='the factor to raise the memory of a container killed '
+                                 'out of memory by')
+        parser.add_argument('--max-memory', dest='max_memory',
+                            default='12Gi',
+                            help='the max memory of a container, files running out of it '
+                                 'are quarantined')
+        parser.add_argument('--cmsrun-attempts', dest='cmsrun_attempts', type=int,
+                            default=2,
+                            help='the number of cmsRun failures, each on another node, after '
+                                 'which a file is quarantined')
+        parser.add_argument('--report', dest='report',
+                            default='quarantine.json',
+                            help='the quarantine report of the files given up on')
+        return parser
+
+    def take_action(self, parsed_args):
+        from higgsdemo.retry import RetryController
+        hd = demo._higgs_demo(parsed_args)
+        RetryController(hd, parsed_args.max_attempts, parsed_args.memory_factor,
+                        parsed_args.max_memory, parsed_args.cmsrun_attempts,
+                        parsed_args.report).run()
+
 
 class Prepare(Command):
     "prepare the cluster for a higgs demo deployment (image pull, ...)"
@@ -209,6 +372,10 @@ class Prepare(Command):
         parser.add_argument('--cluster', dest='cluster',
                             default=None,
                             help='the cluster context to be used')
+        parser.add_argument('--global-inflight', dest='global_inflight', type=int,
+                            default=100,
+                            help='the max number of concurrent api requests over all clusters '
+                                 'of the dataset mapping')
         return parser
 
     def take_action(self, parsed_args):
@@ -219,8 +386,11 @@ class Prepare(Command):
         with open(parsed_args.dataset_mapping, "r") as f:
             datasets = json.load(f)
 
-        import joblib
-        jobs = joblib.Parallel(n_jobs=len(datasets))(joblib.delayed(parallel_prepare)(parsed_args, i) for i, ds in enumerate(datasets))
+        controller = Controller(parsed_args, datasets, parsed_args.global_inflight)
+        try:
+            controller.prepare()
+        finally:
+            controller.close()
 
 
 class Notebook(Command):
@@ -233,6 +403,7 @@ class Notebook(Command):
         return parser
 
     def take_action(self, parsed_args):
+        from jupyterlab.labapp import main as jupyterlab_main
         jupyterlab_main()
 
 
@@ -265,6 +436,7 @@ class ClustersCreate(Command):
         with open(dataset_mapping, "r") as f:
             datasets = json.load(f)
 
+        from google.cloud import container_v1
         client = container_v1.ClusterManagerClient()
         request = container_v1.ListClustersRequest(parent="projects/%s/locations/-" % parsed_args.gcs_project_id)
         clusters = client.list_clusters(request).clusters
@@ -318,6 +490,7 @@ class ClustersDelete(Command):
         if not dataset_mapping:
             raise RuntimeError('dataset mapping file is required')
 
+        from google.cloud import container_v1
         client = container_v1.ClusterManagerClient()
         request = container_v1.ListClustersRequest(parent="projects/%s/locations/-" % parsed_args.gcs_project_id)
         clusters = client.list_clusters(request).clusters
@@ -0,0 +1,72 @@
+import copy
+import logging
+import time
+
+from concurrent import futures
+
+import higgsdemo.main as demo
+from higgsdemo import outputs
+
+log = logging.getLogger(__name__)
+
+
+class Controller(object):
+    """Drives every cluster of a dataset mapping from one process.
+
+    Each cluster gets a HiggsDemo with its own api client, built once and
+    reused for the whole command. The api requests of all clusters go
+    through one shared executor, whose size bounds the requests in flight
+    over the whole campaign. A cluster failing does not stop the others."""
+
+    def __init__(self, args, datasets, global_inflight=100):
+        self.args = args
+        self.datasets = datasets
+        self.executor = futures.ThreadPoolExecutor(max_workers=global_inflight)
+        # one driver thread per cluster, they mostly wait on the executor
+        self.drivers = futures.ThreadPoolExecutor(max_workers=len(datasets))
+        start = time.time()
+        self.demos = self._each(self._demo, range(len(datasets)))
+        log.info('connected to %d clusters in %.2fs', len(self.demos), time.time() - start)
+        if getattr(args, 'resume', False):
+            # the outputs of the run are the same for every cluster
+            completed = outputs.Completed(self.demos[0])
+            for d in self.demos:
+                d._completed = completed
+
+    def _demo(self, i):
+        args = copy.copy(self.args)
+        args.cluster = '{0}{1}'.format(args.prefix, i)
+        args.dataset_index = i
+        args.dataset_mapping = self.datasets
+        d = demo._higgs_demo(args)
+        d.executor = self.executor
+        return d
+
+    def _each(self, fn, items):
+        items = list(items)
+        fs = [self.drivers.submit(fn, item) for item in items]
+        futures.wait(fs)
+        errors = [(item, f.exception()) for item, f in zip(items, fs) if f.exception()]
+        for item, e in errors:
+            log.error('%s failed: %s', getattr(item, 'cluster', item), e)
+        if errors:
+            raise errors[0][1]
+        return [f.result() for f in fs]
+
+    def _timed(self, name, fn):
+        start = time.time()
+        self._each(fn, self.demos)
+        log.info('%s on %d clusters done in %.2fs', name, len(self.demos), time.time() - start)
+
+    def submit(self):
+        self._timed('submit', demo.HiggsDemo.submit)
+
+    def cleanup(self):
+        self._timed('cleanup', demo.HiggsDemo.cleanup)
+
+    def prepare(self):
+        self._timed('prepare', demo.HiggsDemo.prepare)
+
+    def close(self):
+        self.drivers.shutdown()
+        self.executor.shutdown()
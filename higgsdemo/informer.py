@@ -0,0 +1,156 @@
+import json
+import logging
+
+from kubernetes import watch
+from kubernetes.client.rest import ApiException
+
+log = logging.getLogger(__name__)
+
+PHASES = ('Pulling', 'Running', 'Pending', 'Succeeded', 'Failed', 'Unknown')
+
+
+def pod_phase(pod):
+    # pods still downloading their inputs are reported apart from pending ones
+    status = pod.get('status') or {}
+    statuses = status.get('initContainerStatuses')
+    if statuses and statuses[0].get('state', {}).get('running'):
+        return 'Pulling'
+    if status.get('phase') in PHASES:
+        return status['phase']
+    return 'Unknown'
+
+
+class PodStore(object):
+    """Phase of every pod by name, with per phase counters updated by deltas
+    so that an event costs the same however many pods there are."""
+
+    def __init__(self):
+        self.phases = {}
+        self.counts = dict.fromkeys(PHASES, 0)
+
+    def set(self, name, phase):
+        old = self.phases.get(name)
+        if old == phase:
+            return False
+        if old is not None:
+            self.counts[old] -= 1
+        self.phases[name] = phase
+        self.counts[phase] += 1
+        return True
+
+    def delete(self, name):
+        old = self.phases.pop(name, None)
+        if old is None:
+            return False
+        self.counts[old] -= 1
+        return True
+
+    def replace(self, phases):
+        self.phases = phases
+        self.counts = dict.fromkeys(PHASES, 0)
+        for phase in phases.values():
+            self.counts[phase] += 1
+
+    def result(self):
+        return dict(self.counts)
+
+
+class PodInformer(object):
+    """Lists the pods of a namespace once and then follows the watch stream,
+    keeping a PodStore up to date for any number of handlers. An expired
+    resource version (410 Gone) triggers a new list.
+
+    Pods are read as plain json, only the few fields needed are looked at
+    and no client models are built."""
+
+    def __init__(self, core_client, namespace, label_selector=None, limit=200,
+                 timeout_seconds=300):
+        self.core_client = core_client
+        self.namespace = namespace
+        self.label_selector = label_selector
+        self.limit = limit
+        self.timeout_seconds = timeout_seconds
+        self.store = PodStore()
+        self.resource_version = None
+        self.handlers = []
+        self.pod_handlers = []
+
+    def add_handler(self, fn):
+        self.handlers.append(fn)
+
+    def add_pod_handler(self, fn):
+        # called with every pod listed and every pod added or modified
+        self.pod_handlers.append(fn)
+
+    def _notify(self):
+        for fn in self.handlers:
+            fn(self.store)
+
+    def _list_pods(self, *args, **kwargs):
+        # no :return: docstring here, so the watch hands out the raw event
+        # objects instead of deserializing them into models
+        return self.core_client.list_namespaced_pod(
+                *args, label_selector=self.label_selector, **kwargs)
+
+    def list(self):
+        phases = {}
+        c = None
+        while True:
+            resp = self._list_pods(self.namespace, limit=self.limit, _continue=c,
+                                   _preload_content=False)
+            result = json.loads(resp.data)
+            for pod in result['items']:
+                phases[pod['metadata']['name']] = pod_phase(pod)
+                for fn in self.pod_handlers:
+                    fn(pod)
+            c = result['metadata'].get('continue')
+            if not c:
+                break
+        self.store.replace(phases)
+        self.resource_version = result['metadata']['resourceVersion']
+        self._notify()
+
+    def _handle(self, event):
+        if event['type'] == 'ERROR':
+            status = event['raw_object']
+            if status.get('code') == 410:
+                return False
+            raise ApiException(status=status.get('code'), reason=status.get('message'))
+        self.resource_version = event['raw_object']['metadata']['resourceVersion']
+        if event['type'] == 'BOOKMARK':
+            return True
+        pod = event['raw_object']
+        if event['type'] == 'DELETED':
+            changed = self.store.delete(pod['metadata']['name'])
+        else:
+            changed = self.store.set(pod['metadata']['name'], pod_phase(pod))
+            for fn in self.pod_handlers:
+                fn(pod)
+        if changed:
+            self._notify()
+        return True
+
+    def run(self):
+        if self.resource_version is None:
+            self.list()
+        while True:
+            w = watch.Watch()
+            try:
+                for event in w.stream(
+                        self._list_pods, self.namespace,
+                        resource_version=self.resource_version,
+                        timeout_seconds=self.timeout_seconds,
+                        allow_watch_bookmarks=True):
+                    if not self._handle(event):
+                        break
+                else:
+                    # server side timeout, resume from the last version seen
+                    continue
+            except ApiException as e:
+                if e.status != 410:
+                    raise
+            finally:
+                w.stop()
+            log.info('resource version %s expired, listing pods again',
+                     self.resource_version)
+            self.list()
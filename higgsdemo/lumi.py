@@ -0,0 +1,55 @@
+import glob
+import json
+import os
+import threading
+
+_lock = threading.Lock()
+_indexes = {}
+
+
+def object_key(path):
+    """The bucket object key of an input file, eos/opendata/..., given either
+    its eos url or its dataset index entry (<storage>/<bucket>/<key>)."""
+    if path.startswith('root://'):
+        return path.split('//', 2)[2].lstrip('/')
+    return path.split('/', 2)[2]
+
+
+class LumiIndex(object):
+    """Integrated luminosity of every data file, from all lumi/*.json files,
+    keyed by bucket object key."""
+
+    def __init__(self, values, signature):
+        self.values = values
+        self.signature = signature
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, path):
+        return object_key(path) in self.values
+
+    def get(self, path, default=None):
+        return self.values.get(object_key(path), default)
+
+
+def _signature(directory):
+    return tuple((f, os.path.getmtime(f))
+                 for f in sorted(glob.glob(os.path.join(directory, '*.json'))))
+
+
+def load(directory='lumi'):
+    """Returns the lumi index of a directory, read again only when one of its
+    json files was added, removed or modified."""
+    signature = _signature(directory)
+    with _lock:
+        index = _indexes.get(directory)
+        if index is None or index.signature != signature:
+            values = {}
+            for path, _ in signature:
+                with open(path, 'r') as f:
+                    for key, value in json.load(f).items():
+                        values[object_key(key)] = value
+            index = LumiIndex(values, signature)
+            _indexes[directory] = index
+        return index
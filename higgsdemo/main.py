@@ -1,19 +1,82 @@
+import contextlib
 import glob
-import joblib
+import hashlib
+import itertools
 import json
+import logging
 import os
+import random
 import re
 import sys
+import threading
+import time
 import yaml
 
+from concurrent import futures
 from string import Template
 
 from cliff.app import App
 from cliff.commandmanager import CommandManager
-from kubernetes import client
-from kubernetes import config as kube_config
-from kubernetes import utils
-from kubernetes import watch
+
+from higgsdemo import clients
+from higgsdemo import lumi
+from higgsdemo import outputs
+from higgsdemo import plan as higgsplan
+
+# kubernetes is imported where it is used, loading it takes most of the cli
+# start up time and commands like --help never need it
+
+
+log = logging.getLogger(__name__)
+
+
+def _compile(node, fields):
+    """Returns node itself if it does not reference any of fields, else a
+    function of the field values building a fresh copy of node."""
+    if isinstance(node, dict):
+        items = [(k, _compile(v, fields)) for k, v in node.items()]
+        if not any(callable(v) for _, v in items):
+            return node
+        return lambda params: dict(
+                (k, v(params) if callable(v) else v) for k, v in items)
+    if isinstance(node, list):
+        items = [_compile(v, fields) for v in node]
+        if not any(callable(v) for v in items):
+            return node
+        return lambda params: [v(params) if callable(v) else v for v in items]
+    if isinstance(node, str) and '$' in node:
+        template = Template(node)
+        names = set(m.group('named') or m.group('braced')
+                    for m in template.pattern.finditer(node))
+        if not names & fields:
+            return node
+        exact = re.match(r'^\$(\w+)$|^\$\{(\w+)\}$', node)
+        if exact:
+            name = exact.group(1) or exact.group(2)
+            return lambda params: params[name]
+        return lambda params: template.safe_substitute(params)
+    return node
+
+
+class JobTemplate(object):
+    """A job manifest template parsed once, with the values that are the same
+    for every job already substituted. Rendering only fills in the per job
+    fields; parts of the manifest not depending on them are shared between
+    all rendered manifests and must not be modified."""
+
+    def __init__(self, path, fields, prepare=None, **params):
+        with open(path, 'r') as f:
+            content = Template(f.read()).safe_substitute(params)
+        manifest = yaml.safe_load(content)
+        if prepare:
+            prepare(manifest)
+        self.fields = set(fields)
+        self._render = _compile(manifest, self.fields)
+
+    def render(self, **params):
+        if not callable(self._render):
+            return self._render
+        return self._render(params)
 
 
 class HiggsDemo(object):
@@ -28,7 +91,14 @@ class HiggsDemo(object):
             download_max_kb=50000, upload_max_kb=10000,
             run='run6', limit=200, cluster=None, dataset_mapping=None,
             dataset_index=None, gcs_region='europe-west4', prefix='kubecon-demo-',
-            dpath='/mnt/disks/ssd0'):
+            dpath='/mnt/disks/ssd0', max_inflight=20, max_retries=8,
+            indexed=False, max_completions=2000, files_per_job=1,
+            prefetch_window=2, prefetch_max_mb=3000, download_threads=8, storage_region='auto',
+            input_cache='', input_cache_max_mb=50000, schedule=False,
+            file_costs=None, poll_interval=10, global_inflight=100, pool_size=None,
+            keepalive=30, plan=None, output=None, resume=False, max_attempts=4,
+            memory_factor=1.5, max_memory='12Gi', cmsrun_attempts=2, report=None,
+            retry=False):
         super(HiggsDemo, self).__init__()
         self.dataset_pattern = dataset_pattern
         self.dataset_index = dataset_index
@@ -36,13 +106,15 @@ class HiggsDemo(object):
         self.dpath = dpath
         if dataset_mapping:
             self.dataset_mapping = dataset_mapping
-            with open(dataset_mapping, "r") as f:
-                self.dataset_mapping = json.load(f)
-                if self.dataset_index is not None and 'dpath' in self.dataset_mapping[self.dataset_index]:
-                    dpath = self.dataset_mapping[self.dataset_index]['dpath']
-                    if dpath == '/dev/null':
-                        self.ftype = "File"
-                    self.dpath = dpath
+            # the controller hands over the mapping it already parsed
+            if not isinstance(dataset_mapping, list):
+                with open(dataset_mapping, "r") as f:
+                    self.dataset_mapping = json.load(f)
+            if self.dataset_index is not None and 'dpath' in self.dataset_mapping[self.dataset_index]:
+                dpath = self.dataset_mapping[self.dataset_index]['dpath']
+                if dpath == '/dev/null':
+                    self.ftype = "File"
+                self.dpath = dpath
 
         self.namespace = namespace
         self.image = image
@@ -58,7 +130,8 @@ class HiggsDemo(object):
         self.bucket = bucket
         self.output_bucket = output_bucket
         self.cpu_limit = cpu_limit
-        self.backoff_limit = backoff_limit
+        # jobs left to the retry command must not be retried by kubernetes
+        self.backoff_limit = 0 if retry else backoff_limit
         self.multipart_threads = multipart_threads
         self.output_file = output_file
         self.output_json_file = output_json_file
@@ -71,26 +144,173 @@ class HiggsDemo(object):
         self.prefix = prefix
         self.gcs_region = gcs_region
         self.cluster = cluster
+        self.max_inflight = int(max_inflight)
+        self.max_retries = int(max_retries)
+        self.indexed = indexed
+        self.max_completions = int(max_completions)
+        self.files_per_job = int(files_per_job)
+        self.prefetch_window = int(prefetch_window)
+        self.prefetch_max_mb = int(prefetch_max_mb)
+        self.download_threads = int(download_threads)
+        self.storage_region = storage_region
+        self.input_cache = input_cache
+        self.input_cache_max_mb = int(input_cache_max_mb)
+        self.schedule = schedule
+        self.file_costs = file_costs
+        self.poll_interval = poll_interval
+        self.global_inflight = global_inflight
+        self.executor = None
+        self.pool_size = pool_size
+        self.keepalive = int(keepalive)
+        self.resume = resume
+        self._completed = None
 
         self._dataset_job_counter = {}
-        kube_config.load_kube_config(
-                context="gke_%s_%s_%s" % (gcs_project_id, gcs_region, cluster))
-        self.api_client = client.ApiClient()
-        self.core_client = client.CoreV1Api()
-        self.batch_client = client.BatchV1Api()
+        self._template = None
+        self._indexed_template = None
+        self._nodes = None
+        self._backoff_lock = threading.Lock()
+        self._backoff_until = 0
+        self._inflight = threading.BoundedSemaphore(self.max_inflight)
+        self.context = "gke_%s_%s_%s" % (gcs_project_id, gcs_region, cluster)
+        self._clients = None
+
+        self.plan = None
+        if plan:
+            self.plan = higgsplan.load(plan)
+
+    def _kube(self):
+        # connect on first use, planning needs no cluster
+        if self._clients is None:
+            from kubernetes import client
+            api_client = clients.api_client(
+                    self.context, pool_size=self.pool_size or self.max_inflight,
+                    keepalive=self.keepalive)
+            self._clients = (api_client, client.CoreV1Api(api_client),
+                             client.BatchV1Api(api_client))
+        return self._clients
+
+    @property
+    def api_client(self):
+        return self._kube()[0]
+
+    @property
+    def core_client(self):
+        return self._kube()[1]
+
+    @property
+    def batch_client(self):
+        return self._kube()[2]
+
+    def _job_params(self):
+        params = {
+            'namespace': self.namespace, 'run': self.run,
+            'cluster_index': '' if self.dataset_index is None else self.dataset_index,
+            'image': self.image, 's3_basedir': self._s3_basedir(),
+            'cpu_limit': self.cpu_limit, 'backoff_limit': self.backoff_limit,
+            'multipart_threads': self.multipart_threads,
+            'output_file': self.output_file,
+            'output_json_file': self.output_json_file,
+            'redis_host': self.redis_host,
+            'download_max_kb': self.download_max_kb,
+            'upload_max_kb': self.upload_max_kb,
+            'gs_project_id': self.gcs_project_id,
+            'dpath': self.dpath, 'ftype': self.ftype,
+            'files_per_job': self.files_per_job,
+            'prefetch_window': self.prefetch_window if self._prefetch() else 0,
+            'prefetch_max_mb': self.prefetch_max_mb,
+            'download_threads': self.download_threads,
+            'storage_region': self.storage_region
+        }
+        for st in ('s3', 'gs'):
+            params["%s_access_key" % st] = ''
+            params["%s_secret_key" % st] = ''
+            params["%s_host" % st] = ''
+        params["%s_access_key" % self.storage_type] = self.access_key
+        params["%s_secret_key" % self.storage_type] = self.secret_key
+        params["%s_host" % self.storage_type] = self.storage_host
+        return params
 
     def _job_template(self):
-        content = ''
-        with open('job-template.yaml', 'r') as job_file:
-            content = job_file.read()
-            return content
+        if self._template is None:
+            self._template = JobTemplate(
+                    'job-template.yaml',
+                    ('fullsetname', 'jobname', 'config', 'jsonfile', 'file_list',
+                     'cache_node'),
+                    prepare=self._prepare_manifest, **self._job_params())
+        return self._template
 
     def _job_manifest(self, **kwargs):
-        job_template = self._job_template()
-
-        template = Template(self._job_template())
-        manifest = template.safe_substitute(kwargs)
-        return manifest
+        return self._job_template().render(**kwargs)
+
+    def _indexed_job_manifest(self, **kwargs):
+        if self._indexed_template is None:
+            self._indexed_template = JobTemplate(
+                    'job-indexed-template.yaml',
+                    ('fullsetname', 'jobname', 'config', 'jsonfile', 'filelist',
+                     'completions', 'parallelism', 'job_backoff_limit'),
+                    prepare=self._prepare_manifest, **self._job_params())
+        return self._indexed_template.render(**kwargs)
+
+    def _prefetch(self):
+        # a single file pod has nothing to download while cmsRun runs
+        return self.files_per_job > 1 and self.prefetch_window > 0
+
+    def _prepare_manifest(self, manifest):
+        if not self._prefetch():
+            spec = manifest['spec']['template']['spec']
+            spec['containers'] = [c for c in spec['containers'] if c['name'] != 'prefetch']
+        self._add_input_cache(manifest)
+
+    def _add_input_cache(self, manifest):
+        if not self.input_cache:
+            return
+        spec = manifest['spec']['template']['spec']
+        spec['volumes'].append({
+            'name': 'cache',
+            'hostPath': {'path': self.input_cache, 'type': 'DirectoryOrCreate'}})
+        for c in spec['initContainers'] + spec['containers']:
+            if c['name'] in ('prepull', 'prefetch'):
+                c['env'].append({'name': 'INPUT_CACHE', 'value': '/cache'})
+                c['env'].append({'name': 'INPUT_CACHE_MAX_MB',
+                                 'value': str(self.input_cache_max_mb)})
+                c['volumeMounts'].append({'name': 'cache', 'mountPath': '/cache'})
+        # the pods of an indexed job share one template, so only single
+        # jobs can ask for the node caching their input
+        if manifest['spec'].get('completionMode') != 'Indexed':
+            spec['affinity'] = {'nodeAffinity': {
+                'preferredDuringSchedulingIgnoredDuringExecution': [{
+                    'weight': 100,
+                    'preference': {'matchExpressions': [{
+                        'key': 'kubernetes.io/hostname', 'operator': 'In',
+                        'values': ['$cache_node']}]}}]}}
+
+    def _cache_node(self, eventfile):
+        # rendezvous hashing sends a file to the same node on every run, as
+        # long as that node exists, so repeated runs hit its input cache
+        if self._nodes is None:
+            self._nodes = [
+                n.metadata.labels.get('kubernetes.io/hostname', n.metadata.name)
+                for n in self.core_client.list_node().items
+                if not n.spec.unschedulable]
+        if not self._nodes:
+            return ''
+        return max(self._nodes, key=lambda n: hashlib.sha1(
+            ('%s %s' % (n, eventfile)).encode('utf-8')).hexdigest())
+
+    def _file_list(self, work):
+        return ''.join('%s\t%s\t%s\n' % (w['eventfile'], w['s3_outputpath'], w['lumi_data'])
+                       for w in work)
+
+    def _filelist_manifest(self, name, work):
+        lines = self._file_list(work)
+        return {
+            'apiVersion': 'v1', 'kind': 'ConfigMap',
+            'metadata': {'name': name, 'namespace': self.namespace,
+                         'labels': {'higgsdemo/component': 'filelist',
+                                    'higgsdemo/run': self.run}},
+            'data': {'files': lines},
+        }
 
     def _jsonfile(self, year):
         jsonfiles = {
@@ -137,63 +357,133 @@ class HiggsDemo(object):
         return "%s/%s/testoutputs/higgs4lbucket/%s/eventselection" % (
                 self.storage_type, self.bucket, self.run)
 
-    def _kube_submit(self, manifests):
+    def _backoff(self, exc, attempt):
+        delay = min(0.5 * 2 ** attempt, 30) * random.uniform(0.5, 1.0)
+        if exc.headers and exc.headers.get('Retry-After'):
+            try:
+                delay = max(delay, float(exc.headers['Retry-After']))
+            except ValueError:
+                pass
+        with self._backoff_lock:
+            self._backoff_until = max(self._backoff_until, time.time() + delay)
+        log.warning('%s: api server returned %s, backing off %.1fs',
+                    self.cluster, exc.status, delay)
+
+    def _call(self, fn, *args, **kwargs):
+        from kubernetes.client.rest import ApiException
+        attempt = 0
+        while True:
+            wait = self._backoff_until - time.time()
+            if wait > 0:
+                time.sleep(wait)
+            try:
+                return fn(*args, **kwargs)
+            except ApiException as e:
+                if attempt >= self.max_retries or not (e.status == 429 or (e.status or 0) >= 500):
+                    raise
+                self._backoff(e, attempt)
+                attempt += 1
+
+    def _executor(self):
+        # several clusters driven by one controller share its executor, which
+        # must outlive each single operation
+        if self.executor is not None:
+            return contextlib.nullcontext(self.executor)
+        return futures.ThreadPoolExecutor(max_workers=self.max_inflight)
+
+    def _create(self, fn, body):
+        from kubernetes.client.rest import ApiException
+        try:
+            return self._call(fn, self.namespace, body=body)
+        except ApiException as e:
+            # created by an earlier submit of this run
+            if e.status != 409:
+                raise
+            log.debug('%s: %s %s exists already', self.cluster, body['kind'],
+                      body['metadata']['name'])
+
+    def _create_job(self, body):
+        with self._inflight:
+            return self._create(self.batch_client.create_namespaced_job, body)
+
+    def _create_configmaps(self):
+        from kubernetes import utils
         try:
             utils.create_from_yaml(self.api_client, 'cm-runjob.yaml')
         except Exception as e:
             pass
-        for i in range(0, len(manifests), self.limit):
-            yaml = ''
-            for m in manifests[i:i + self.limit]:
-                yaml += "\n---\n%s" % m
-            f = open('/tmp/{0}'.format(self.cluster), 'w')
-            f.write(yaml)
-            f.close()
-            utils.create_from_yaml(self.api_client, '/tmp/{0}'.format(self.cluster))
+
+    def _kube_submit(self, manifests):
+        self._create_configmaps()
+        self._create_jobs(manifests)
+
+    def _create_jobs(self, manifests):
+        manifests = iter(manifests)
+        total, start = 0, time.time()
+        with self._executor() as executor:
+            batch = list(itertools.islice(manifests, self.limit))
+            while batch:
+                batch_start = time.time()
+                results = [executor.submit(self._create_job, m) for m in batch]
+                # render the next batch while the current one is in flight
+                next_batch = list(itertools.islice(manifests, self.limit))
+                for r in results:
+                    r.result()
+                elapsed = time.time() - batch_start
+                total += len(batch)
+                log.info('%s: created %d jobs in %.2fs (%.1f jobs/s), %d total (%.1f jobs/s)',
+                         self.cluster, len(batch), elapsed, len(batch) / max(elapsed, 1e-6),
+                         total, total / max(time.time() - start, 1e-6))
+                batch = next_batch
+
+    def _cleanup_dataset(self, fullsetname):
+        selector = '%s,higgsdemo/dataset=%s' % (self._selector(), fullsetname)
+        self._call(self.batch_client.delete_collection_namespaced_job,
+                   self.namespace, label_selector=selector,
+                   propagation_policy='Background')
 
     def _cleanup_jobs(self):
-        result = self.batch_client.delete_collection_namespaced_job(
-                self.namespace, limit = self.limit).to_dict()
-        c = result['metadata'].get('_continue')
-        while c:
-            result = self.batch_client.delete_collection_namespaced_job(
-                    self.namespace, limit = self.limit, _continue = c).to_dict()
-            c = result['metadata'].get('_continue')
+        # one delete per dataset, in parallel; the garbage collector removes
+        # the pods of the deleted jobs in the background
+        datasets = {}
+        for job in self._get_jobs():
+            name = job['metadata'].get('labels', {}).get('higgsdemo/dataset', '')
+            datasets[name] = datasets.get(name, 0) + 1
+        start = time.time()
+        with self._executor() as executor:
+            results = dict((executor.submit(self._cleanup_dataset, name), name)
+                           for name in datasets)
+            for r in futures.as_completed(results):
+                r.result()
+                log.info('%s: deleted %d jobs of %s in %.2fs', self.cluster,
+                         datasets[results[r]], results[r], time.time() - start)
+        total, elapsed = sum(datasets.values()), time.time() - start
+        log.info('%s: deleted %d jobs of %d datasets in %.2fs (%.1f jobs/s)',
+                 self.cluster, total, len(datasets), elapsed, total / max(elapsed, 1e-6))
 
     def _cleanup_pods(self):
-        result = self.core_client.delete_collection_namespaced_pod(
-                self.namespace, limit = self.limit).to_dict()
-        c = result['metadata'].get('_continue')
-        while c:
-            result = self.core_client.delete_collection_namespaced_pod(
-                    self.namespace, limit = self.limit, _continue = c).to_dict()
-            c = result['metadata'].get('_continue')
-      
+        # pods left behind by jobs deleted without propagation
+        self._call(self.core_client.delete_collection_namespaced_pod,
+                   self.namespace, label_selector=self._selector())
+
+    def _selector(self):
+        # an empty run selects the objects of every demo run
+        if not self.run:
+            return 'higgsdemo/run'
+        return 'higgsdemo/run=%s' % self.run
+
     def _get_jobs(self):
-        result = self.batch_client.list_namespaced_job(
-                self.namespace, limit=self.limit).to_dict()
-        c = result['metadata'].get('_continue')
-        jobs = result['items']
-        while c:
-            result = self.batch_client.list_namespaced_job(
-                self.namespace, limit=self.limit, _continue = c).to_dict()
-            c = result['metadata'].get('_continue')
+        # plain json instead of client models, callers only look at a few fields
+        jobs, c = [], None
+        while True:
+            resp = self.batch_client.list_namespaced_job(
+                self.namespace, label_selector=self._selector(), limit=self.limit,
+                _continue=c, _preload_content=False)
+            result = json.loads(resp.data)
             jobs.extend(result['items'])
-        return jobs
-
-    def _get_pods(self):
-        result = self.core_client.list_namespaced_pod(
-                self.namespace, limit=self.limit).to_dict()
-        c = result['metadata'].get('_continue')
-        pods = result['items']
-        while c:
-            result = self.core_client.list_namespaced_pod(
-                self.namespace, limit=self.limit, _continue = c).to_dict()
-            c = result['metadata'].get('_continue')
-            pods.extend(result['items'])
-
-        rv = result['metadata']['resource_version']
-        return pods, rv
+            c = result['metadata'].get('continue')
+            if not c:
+                return jobs
 
     def _dataset_files(self):
         if self.dataset_pattern:
@@ -206,91 +496,74 @@ class HiggsDemo(object):
         try:
             self.core_client.delete_namespaced_config_map('runjob', self.namespace)
             self.core_client.delete_namespaced_config_map('getfile', self.namespace)
+            self.core_client.delete_namespaced_config_map('indexed', self.namespace)
         except:
             pass
+        self.core_client.delete_collection_namespaced_config_map(
+                self.namespace,
+                label_selector='higgsdemo/component=filelist,' + self._selector())
         self._cleanup_jobs()
         self._cleanup_pods()
 
     def prepare(self):
+        from kubernetes import utils
         try:
             utils.create_from_yaml(self.api_client, 'ds-prepull.yaml')
         except Exception as exc:
             pass
 
     def status(self, fn=None):
-        self._pods = {'Pulling': [], 'Running': [], 'Pending': [], 'Succeeded': [], 'Failed': [], 'Unknown': []}
-        pods, rv = self._get_pods()
-        for pod in pods:
-            pod_name = pod['metadata']['name']
-            phase = pod['status']['phase']
-            prepull = None
-            if pod['status']['init_container_statuses']:
-                prepull = pod['status']['init_container_statuses'][0]['state']['running']
-            for p in self._pods.keys():
-                try:
-                    self._pods[p].remove(pod_name)
-                except:
-                    pass
-            if prepull:
-                self._pods['Pulling'].append(pod_name)
-            else:
-                self._pods[phase].append(pod_name)
-
-        result = {}
-        for p in self._pods.keys():
-            result[p] = len(self._pods[p])
-
+        from higgsdemo.informer import PodInformer
+        planned = None
+        if self.plan:
+            planned = self.plan.jobs(self.dataset_index, self.files_per_job)
+
+        def result(store):
+            r = store.result()
+            if planned is not None:
+                r['Planned'] = planned
+            return r
+
+        informer = PodInformer(self.core_client, self.namespace,
+                               label_selector=self._selector(), limit=self.limit)
+        informer.list()
         if not fn:
-            return result
-
-        fn(result)
-        w = watch.Watch()
-        api = self.core_client
-        for item in w.stream(
-            api.list_namespaced_pod, namespace=self.namespace,
-                timeout_seconds=0, resource_version=rv):
-            pod_name = item['object'].metadata.name
-            phase = item['object'].status.phase
-            prepull = None
-            if item['object'].status.init_container_statuses:
-                prepull = item['object'].status.init_container_statuses[0].state.running
-            t = item['type']
-            for p in self._pods.keys():
-                try:
-                    self._pods[p].remove(pod_name)
-                except:
-                    pass
-            if t != 'DELETED':
-                if prepull:
-                    self._pods['Pulling'].append(pod_name)
-                else:
-                    self._pods[phase].append(pod_name)
-            result = {}
-            for p in self._pods.keys():
-                result[p] = len(self._pods[p])
-
-            fn(result)
-
-    def submit(self):
-        s3_basedir = self._s3_basedir()
-        manifests = []
-
-        dataset_files = self._dataset_files()
+            return result(informer.store)
+
+        fn(result(informer.store))
+        informer.add_handler(lambda store: fn(result(store)))
+        informer.run()
+
+    def _eventfiles(self, datasetfile):
+        with open(datasetfile, 'r') as f:
+            for eventfile in f:
+                yield eventfile.strip()
+
+    def _work(self, dataset_files=None):
+        if dataset_files is None:
+            if self.plan:
+                return self._remaining(self.plan.work(self.dataset_index))
+            dataset_files = self._dataset_files()
+        return self._remaining(self._parse_work(dataset_files))
+
+    def _remaining(self, work):
+        # on resume, leave out the files with results from an earlier submit
+        if not self.resume:
+            return work
+        if self._completed is None:
+            self._completed = outputs.Completed(self)
+        return self._completed.remaining(work)
+
+    def _parse_work(self, dataset_files):
+        lumi_index = lumi.load()
         for datasetfile in dataset_files:
             datasetname = self._datasetname(datasetfile)
             fullsetname = self._fullsetname(datasetname)
-            is_data = False
-            if 'cms_run' in fullsetname: #is data and not simulation
-                lumi_data = json.load(open('lumi/{}.json'.format(fullsetname)))
-                is_data = True
-            else:
-                lumi_data = {}
+            is_data = 'cms_run' in fullsetname #is data and not simulation
             if not os.path.isfile(datasetfile):
                 continue
-            for eventfile in open(datasetfile).readlines():
-                eventfile = eventfile.strip()
-                eospath = eventfile.replace('s3/higgs-demo','root://eospublic.cern.ch/')
-                lumi_value_for_file = lumi_data.get(eospath)
+            for eventfile in self._eventfiles(datasetfile):
+                lumi_value_for_file = lumi_index.get(eventfile) if is_data else None
                 year_for_file = None
                 stream_for_file = None
                 lumi_data_for_file = None
@@ -315,39 +588,91 @@ class HiggsDemo(object):
                     config_json_file = ''
 
                 self._dataset_job_counter.setdefault(fullsetname, 0)
-                cur = self._dataset_job_counter[fullsetname]
                 self._dataset_job_counter[fullsetname] += 1
                 jobname = self._jobname(datasetname, fullsetname)
                 s3_outputpath = self._s3_outputpath(datasetname, fullsetname)
 
-                params = {
-                    'datasetname': datasetname, 'namespace': self.namespace,
-                    'fullsetname': fullsetname, 'eventfile': eventfile.strip().replace('s3', self.storage_type).replace('higgs-demo', self.bucket),
+                yield {
+                    'datasetname': datasetname, 'fullsetname': fullsetname,
+                    'eventfile': eventfile.replace('s3', self.storage_type).replace('higgs-demo', self.bucket),
                     'jobname': jobname, 's3_outputpath': s3_outputpath,
                     'config': config, 'jsonfile': config_json_file,
-                    'image': self.image, 's3_basedir': s3_basedir,
-                    'cpu_limit': self.cpu_limit, 'backoff_limit': self.backoff_limit,
-                    'multipart_threads': self.multipart_threads,
-                    'output_file': self.output_file,
-                    'output_json_file': self.output_json_file,
-                    'redis_host': self.redis_host,
-                    'download_max_kb': self.download_max_kb,
-                    'upload_max_kb': self.upload_max_kb,
-                    'gs_project_id': self.gcs_project_id,
                     'lumi_data': json.dumps(lumi_data_for_file),
-                    'dpath': self.dpath, 'ftype': self.ftype
                 }
-                for st in ('s3', 'gs'):
-                    params["%s_access_key" % st] = ''
-                    params["%s_secret_key" % st] = ''
-                    params["%s_host" % st] = ''
-                params["%s_access_key" % self.storage_type] = self.access_key
-                params["%s_secret_key" % self.storage_type] = self.secret_key
-                params["%s_host" % self.storage_type] = self.storage_host
 
-                manifests.append(self._job_manifest(**params))
+    def _job_groups(self, work=None):
+        # consecutive files of the same dataset share a pod
+        group = []
+        for params in (self._work() if work is None else work):
+            if group and (len(group) >= self.files_per_job or
+                          group[0]['fullsetname'] != params['fullsetname']):
+                yield group
+                group = []
+            group.append(params)
+        if group:
+            yield group
+
+    def _group_manifest(self, work):
+        params = {}
+        if self.input_cache:
+            params['cache_node'] = self._cache_node(work[0]['eventfile'])
+        return self._job_manifest(
+                fullsetname=work[0]['fullsetname'], jobname=work[0]['jobname'],
+                config=work[0]['config'], jsonfile=work[0]['jsonfile'],
+                file_list=self._file_list(work), **params)
+
+    def _manifests(self):
+        for work in self._job_groups():
+            yield self._group_manifest(work)
+
+    def _indexed_job(self, fullsetname, chunk, work):
+        jobname = '{}-{}'.format(fullsetname, str(chunk).zfill(2)).replace('_', '')
+        self._create(self.core_client.create_namespaced_config_map,
+                     self._filelist_manifest(jobname, work))
+        completions = -(-len(work) // self.files_per_job)
+        return self._indexed_job_manifest(
+                fullsetname=fullsetname, jobname=jobname,
+                config=work[0]['config'], jsonfile=work[0]['jsonfile'],
+                filelist=jobname, completions=completions, parallelism=completions,
+                job_backoff_limit=int(self.backoff_limit) * completions)
+
+    def _indexed_manifests(self):
+        # one indexed job per dataset, split in chunks so that the file list
+        # stays well within the configmap size limit
+        pending, chunks = {}, {}
+        for params in self._work():
+            fullsetname = params['fullsetname']
+            work = pending.setdefault(fullsetname, [])
+            work.append(params)
+            if len(work) >= self.max_completions:
+                chunk = chunks.get(fullsetname, 0)
+                chunks[fullsetname] = chunk + 1
+                yield self._indexed_job(fullsetname, chunk, pending.pop(fullsetname))
+        for fullsetname, work in pending.items():
+            yield self._indexed_job(fullsetname, chunks.get(fullsetname, 0), work)
+
+    def write_plan(self, path):
+        # one counter over all mapping entries keeps job names and outputs
+        # unique whichever cluster runs them
+        if self.dataset_mapping and not self.dataset_pattern:
+            work = [(i, self._parse_work(entry['datasets']))
+                    for i, entry in enumerate(self.dataset_mapping)]
+        else:
+            work = [(self.dataset_index, self._parse_work(self._dataset_files()))]
+        doc = higgsplan.build(work, self.storage_type, self.bucket)
+        higgsplan.write(doc, path)
+        log.info('planned %d files of %d datasets in %s', len(doc['columns']['jobname']),
+                 len(doc['datasets']), path)
 
-        self._kube_submit(manifests)
+    def submit(self):
+        if self.plan and (self.plan.doc['storage_type'], self.plan.doc['bucket']) != (
+                self.storage_type, self.bucket):
+            raise RuntimeError('the plan was made for {}/{}, not {}/{}'.format(
+                self.plan.doc['storage_type'], self.plan.doc['bucket'],
+                self.storage_type, self.bucket))
+        if self.indexed:
+            return self._kube_submit(self._indexed_manifests())
+        self._kube_submit(self._manifests())
 
 
 class HiggsDemoCli(App):
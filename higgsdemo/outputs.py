@@ -0,0 +1,37 @@
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+
+def published(redis_host):
+    """The names of the input files whose results are in the redis data hash,
+    which runjob.sh keys by /tmp/outputs/<input file name>."""
+    import redis
+    r = redis.StrictRedis(host=redis_host)
+    return set(os.path.basename(k.decode('utf-8')) for k in r.hkeys('data'))
+
+
+class Completed(object):
+    """The files of a run already processed, from the results published to
+    redis. A redis that cannot be read fails the resume rather than
+    submitting every file again."""
+
+    def __init__(self, demo):
+        start = time.time()
+        self.inputs = published(demo.redis_host)
+        log.info('%s: %d results in redis, read in %.2fs',
+                 demo.cluster, len(self.inputs), time.time() - start)
+
+    def __contains__(self, work):
+        return os.path.basename(work['eventfile']) in self.inputs
+
+    def remaining(self, work):
+        done = 0
+        for w in work:
+            if w in self:
+                done += 1
+                continue
+            yield w
+        log.info('skipping %d files already processed', done)
@@ -0,0 +1,125 @@
+import json
+import logging
+import os
+import time
+
+log = logging.getLogger(__name__)
+
+VERSION = 1
+
+# columns holding few distinct values are stored as indices into a table
+_INDEXED = ('fullsetname', 'config', 'jsonfile', 'lumi_stream')
+_COLUMNS = ('cluster', 'fullsetname', 'eventfile', 'jobname', 'output', 'config',
+            'jsonfile', 'lumi_stream', 'lumi_value')
+
+_plans = {}
+
+
+class Plan(object):
+    """The input files of a run, one row per file, stored by column.
+
+    A plan is written once by the plan command, from the dataset index
+    files and lumi data, and then loaded by submit, status and the plotting
+    code instead of parsing those again."""
+
+    def __init__(self, doc):
+        self.doc = doc
+        self.columns = doc['columns']
+        self.datasets = doc['datasets']
+
+    def __len__(self):
+        return len(self.columns['jobname'])
+
+    def _rows(self, cluster):
+        clusters = self.columns['cluster']
+        if cluster is None:
+            return range(len(clusters))
+        return [i for i, c in enumerate(clusters) if c == cluster]
+
+    def work(self, cluster=None):
+        c = self.columns
+        tables = self.doc['tables']
+        for i in self._rows(cluster):
+            lumi = None
+            if c['lumi_stream'][i] is not None:
+                lumi = {'stream': tables['lumi_stream'][c['lumi_stream'][i]],
+                        'value': c['lumi_value'][i]}
+            yield {
+                'fullsetname': tables['fullsetname'][c['fullsetname'][i]],
+                'eventfile': c['eventfile'][i], 'jobname': c['jobname'][i],
+                's3_outputpath': c['output'][i],
+                'config': tables['config'][c['config'][i]],
+                'jsonfile': tables['jsonfile'][c['jsonfile'][i]],
+                'lumi_data': json.dumps(lumi),
+            }
+
+    def jobs(self, cluster=None, files_per_job=1):
+        # the number of jobs submit makes of these rows, see _job_groups
+        names = self.columns['fullsetname']
+        jobs, size, last = 0, 0, None
+        for i in self._rows(cluster):
+            if last != names[i] or size >= files_per_job:
+                jobs += 1
+                size = 0
+            last = names[i]
+            size += 1
+        return jobs
+
+
+def build(work_by_cluster, storage_type, bucket):
+    """Builds the plan document of (cluster, work) pairs, where work is the
+    iterable of per file dicts of HiggsDemo._work."""
+    tables = dict((name, []) for name in _INDEXED)
+    index = dict((name, {}) for name in _INDEXED)
+    columns = dict((name, []) for name in _COLUMNS)
+    datasets = {}
+
+    def add(name, value):
+        if name in _INDEXED and value is not None:
+            if value not in index[name]:
+                index[name][value] = len(tables[name])
+                tables[name].append(value)
+            value = index[name][value]
+        columns[name].append(value)
+
+    for cluster, work in work_by_cluster:
+        for w in work:
+            lumi = json.loads(w['lumi_data'])
+            add('cluster', cluster)
+            add('fullsetname', w['fullsetname'])
+            add('eventfile', w['eventfile'])
+            add('jobname', w['jobname'])
+            add('output', w['s3_outputpath'])
+            add('config', w['config'])
+            add('jsonfile', w['jsonfile'])
+            add('lumi_stream', lumi['stream'] if lumi else None)
+            add('lumi_value', lumi['value'] if lumi else None)
+            datasets[w['fullsetname']] = datasets.get(w['fullsetname'], 0) + 1
+
+    return {'version': VERSION, 'storage_type': storage_type, 'bucket': bucket,
+            'datasets': datasets, 'tables': tables, 'columns': columns}
+
+
+def write(doc, path):
+    tmp = '%s.tmp' % path
+    with open(tmp, 'w') as f:
+        json.dump(doc, f, separators=(',', ':'))
+    os.rename(tmp, path)
+
+
+def load(path):
+    """Loads a plan, parsing the file again only once it changed."""
+    mtime = os.path.getmtime(path)
+    cached = _plans.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    start = time.time()
+    with open(path, 'r') as f:
+        doc = json.load(f)
+    if doc.get('version') != VERSION:
+        raise RuntimeError('plan {} has version {}, expected {}'.format(
+            path, doc.get('version'), VERSION))
+    plan = Plan(doc)
+    _plans[path] = (mtime, plan)
+    log.debug('loaded plan %s with %d files in %.3fs', path, len(plan), time.time() - start)
+    return plan
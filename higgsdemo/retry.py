@@ -0,0 +1,210 @@
+import itertools
+import json
+import logging
+import os
+import re
+
+from kubernetes.client.rest import ApiException
+
+from higgsdemo.informer import PodInformer
+
+log = logging.getLogger(__name__)
+
+FAILURES = 'higgsdemo/failures'
+
+# the termination message of cmsrun when the prefetch container failed
+PREFETCH_FAILED = 'prefetch failed'
+
+_UNITS = {'Ki': 2 ** 10, 'Mi': 2 ** 20, 'Gi': 2 ** 30, 'Ti': 2 ** 40,
+          'k': 10 ** 3, 'M': 10 ** 6, 'G': 10 ** 9, 'T': 10 ** 12}
+
+# labels the job controller adds to the jobs it runs, a copy gets new ones
+_GENERATED = ('controller-uid', 'job-name', 'batch.kubernetes.io/controller-uid',
+              'batch.kubernetes.io/job-name')
+
+
+def _bytes(quantity):
+    m = re.match(r'^([0-9.]+)([A-Za-z]*)$', str(quantity))
+    return int(float(m.group(1)) * _UNITS.get(m.group(2), 1))
+
+
+def _terminated(statuses):
+    for c in statuses or []:
+        t = (c.get('state') or {}).get('terminated') or {}
+        if t.get('exitCode'):
+            yield c['name'], t
+
+
+def classify(pod):
+    """Why a failed pod failed, as (reason, container, terminated state):
+    oom, download (the input download containers), cmsrun or node."""
+    status = pod.get('status') or {}
+    if status.get('reason') == 'Evicted':
+        return 'node', None, {'message': status.get('message')}
+    # init containers first, they ran first
+    for name, t in itertools.chain(_terminated(status.get('initContainerStatuses')),
+                                   _terminated(status.get('containerStatuses'))):
+        if t.get('reason') == 'OOMKilled':
+            return 'oom', name, t
+        if name == 'cmsrun':
+            # the kernel kills cmsRun rather than the shell running it, which
+            # then exits with 128 + SIGKILL
+            if t['exitCode'] == 137:
+                return 'oom', name, t
+            if (t.get('message') or '').startswith(PREFETCH_FAILED):
+                return 'download', name, t
+            return 'cmsrun', name, t
+        return 'download', name, t
+    return 'node', None, {'message': status.get('message')}
+
+
+class RetryController(object):
+    """Resubmits the failed jobs of a run, adjusted to why they failed.
+
+    Follows the pods of the run and, for every pod failing in a job with a
+    backoff limit of 0, reads that job and creates a copy of it: with more
+    memory for the container that ran out of it, away from the failed
+    node otherwise. The failures of a file are kept in an annotation of its
+    jobs, so a restarted controller carries on where it stopped. Files
+    still failing once out of attempts, out of memory at max_memory or
+    failing cmsRun twice are written to the quarantine report instead."""
+
+    def __init__(self, demo, max_attempts=4, memory_factor=1.5, max_memory='12Gi',
+                 cmsrun_attempts=2, report='quarantine.json'):
+        self.demo = demo
+        self.max_attempts = int(max_attempts)
+        self.memory_factor = float(memory_factor)
+        self.max_memory = _bytes(max_memory)
+        self.cmsrun_attempts = int(cmsrun_attempts)
+        self.report = report
+        self.quarantined = {}
+        if os.path.exists(report):
+            with open(report, 'r') as f:
+                self.quarantined = json.load(f)
+        self.handled = set()
+        self.left = set()
+
+    def _read_job(self, name):
+        demo = self.demo
+        resp = demo._call(demo.batch_client.read_namespaced_job, name, demo.namespace,
+                          _preload_content=False)
+        return json.loads(resp.data)
+
+    def _files(self, job):
+        for c in job['spec']['template']['spec']['containers']:
+            for e in c.get('env') or []:
+                if e['name'] == 'CMS_FILE_LIST':
+                    return [l.split('\t')[0] for l in e.get('value', '').splitlines() if l]
+        return []
+
+    def _quarantine(self, base, job, failures, pod, why):
+        entry = {'job': base, 'files': self._files(job), 'failures': failures,
+                 'node': pod['spec'].get('nodeName'), 'reason': why}
+        self.quarantined[base] = entry
+        tmp = '%s.tmp' % self.report
+        with open(tmp, 'w') as f:
+            json.dump(self.quarantined, f, indent=2, sort_keys=True)
+        os.rename(tmp, self.report)
+        log.warning('%s: quarantined %s: %s', self.demo.cluster, base, why)
+
+    def _resubmit(self, job, name, failures, container, node):
+        spec = job['spec']
+        template = spec['template']
+        for key in _GENERATED:
+            template['metadata'].get('labels', {}).pop(key, None)
+        spec.pop('selector', None)
+        spec.pop('manualSelector', None)
+        annotations = dict(job['metadata'].get('annotations') or {})
+        annotations[FAILURES] = ','.join(failures)
+        job = {'apiVersion': 'batch/v1', 'kind': 'Job', 'spec': spec,
+               'metadata': {'name': name, 'namespace': self.demo.namespace,
+                            'labels': job['metadata'].get('labels') or {},
+                            'annotations': annotations}}
+
+        pod_spec = template['spec']
+        if failures[-1] == 'oom':
+            for c in pod_spec.get('initContainers', []) + pod_spec['containers']:
+                if c['name'] == container:
+                    resources = c.setdefault('resources', {})
+                    memory = min(int(_bytes(resources.get('limits', {}).get('memory', '6Gi')) *
+                                     self.memory_factor), self.max_memory)
+                    memory = '%dMi' % -(-memory // 2 ** 20)
+                    resources.setdefault('requests', {})['memory'] = memory
+                    resources.setdefault('limits', {})['memory'] = memory
+                    log.info('%s: %s gets %s for %s', self.demo.cluster, name, memory, container)
+        elif node:
+            affinity = pod_spec.setdefault('affinity', {}).setdefault('nodeAffinity', {})
+            terms = affinity.setdefault(
+                    'requiredDuringSchedulingIgnoredDuringExecution',
+                    {'nodeSelectorTerms': [{}]})['nodeSelectorTerms']
+            for term in terms:
+                fields = term.setdefault('matchFields', [])
+                excluded = [f for f in fields if f['key'] == 'metadata.name' and
+                            f['operator'] == 'NotIn']
+                if not excluded:
+                    excluded = [{'key': 'metadata.name', 'operator': 'NotIn', 'values': []}]
+                    fields.append(excluded[0])
+                excluded[0]['values'].append(node)
+            log.info('%s: %s avoids node %s', self.demo.cluster, name, node)
+        self.demo._create(self.demo.batch_client.create_namespaced_job, job)
+
+    def handle(self, pod):
+        if (pod.get('status') or {}).get('phase') != 'Failed':
+            return
+        name = pod['metadata']['name']
+        jobname = (pod['metadata'].get('labels') or {}).get('job-name')
+        if not jobname or name in self.handled:
+            return
+        self.handled.add(name)
+        if 'batch.kubernetes.io/job-completion-index' in (pod['metadata'].get('annotations') or {}):
+            return
+
+        try:
+            job = self._read_job(jobname)
+        except ApiException as e:
+            if e.status == 404:
+                return
+            raise
+        if job['spec'].get('backoffLimit'):
+            if jobname not in self.left:
+                self.left.add(jobname)
+                log.info('%s: %s retries itself, it was not submitted with --retry',
+                         self.demo.cluster, jobname)
+            return
+
+        reason, container, terminated = classify(pod)
+        failures = [f for f in (job['metadata'].get('annotations') or {}).get(
+            FAILURES, '').split(',') if f] + [reason]
+        base = re.sub(r'-r[0-9]+$', '', jobname)
+        log.info('%s: %s failed (%s in %s, exit code %s)', self.demo.cluster, jobname,
+                 reason, container, terminated.get('exitCode'))
+
+        why = None
+        if len(failures) >= self.max_attempts:
+            why = 'failed %d times' % len(failures)
+        elif reason == 'cmsrun' and failures.count('cmsrun') >= self.cmsrun_attempts:
+            why = 'cmsRun failed on %d nodes, last exit code %s' % (
+                failures.count('cmsrun'), terminated.get('exitCode'))
+        elif reason == 'oom' and self._memory(job, container) >= self.max_memory:
+            why = 'out of memory at %s' % self._limit(job, container)
+        if why:
+            self._quarantine(base, job, failures, pod, why)
+            return
+        self._resubmit(job, '%s-r%d' % (base, len(failures)), failures, container,
+                       pod['spec'].get('nodeName'))
+
+    def _limit(self, job, container):
+        spec = job['spec']['template']['spec']
+        for c in spec.get('initContainers', []) + spec['containers']:
+            if c['name'] == container:
+                return c.get('resources', {}).get('limits', {}).get('memory', '6Gi')
+        return '0'
+
+    def _memory(self, job, container):
+        return _bytes(self._limit(job, container))
+
+    def run(self):
+        informer = PodInformer(self.demo.core_client, self.demo.namespace,
+                               label_selector=self.demo._selector(), limit=self.demo.limit)
+        informer.add_pod_handler(self.handle)
+        informer.run()
@@ -0,0 +1,208 @@
+import collections
+import json
+import logging
+import os
+import time
+
+from concurrent import futures
+from kubernetes.client.rest import ApiException
+
+log = logging.getLogger(__name__)
+
+
+def _cpu(quantity):
+    quantity = str(quantity)
+    if quantity.endswith('m'):
+        return float(quantity[:-1]) / 1000
+    return float(quantity)
+
+
+def _pod_cpu(manifest):
+    # what the scheduler reserves for a pod: its containers together, or the
+    # largest init container if that is bigger
+    spec = manifest['spec']['template']['spec']
+
+    def request(c):
+        return _cpu(c.get('resources', {}).get('requests', {}).get('cpu', 0))
+
+    return max([sum(request(c) for c in spec['containers'])] +
+               [request(c) for c in spec.get('initContainers') or []])
+
+
+class Cluster(object):
+
+    def __init__(self, demo):
+        self.demo = demo
+        self.pod_cpu = None
+        self.slots = 0
+        self.jobs = {}
+        self.unscheduled = []
+        self.lost = []
+        self.stolen = []
+        self.succeeded = 0
+        self.failed = 0
+        self.cost = 0.0
+
+    def target(self):
+        # keep a small backlog of pending pods so that slots freed between
+        # two polls are filled right away
+        return self.slots + max(1, self.slots // 10)
+
+    def free(self):
+        if self.unscheduled:
+            return 0
+        return self.target() - len(self.jobs)
+
+    def refresh(self):
+        demo = self.demo
+        self.slots = sum(
+            int(_cpu(n.status.allocatable['cpu']) // self.pod_cpu)
+            for n in demo.core_client.list_node().items if not n.spec.unschedulable)
+
+        listed = set()
+        for job in demo._get_jobs():
+            name = job['metadata']['name']
+            if name not in self.jobs:
+                continue
+            listed.add(name)
+            status = job['status']
+            if status.get('succeeded'):
+                self.succeeded += 1
+                self.cost += self.jobs.pop(name)[0]
+            elif any(c['type'] == 'Failed' and c['status'] == 'True'
+                     for c in status.get('conditions') or []):
+                log.warning('%s: job %s failed', demo.cluster, name)
+                self.failed += 1
+                self.jobs.pop(name)
+
+        # jobs created a while ago but gone from the cluster were deleted
+        # behind our back, they go back to the queue
+        cutoff = time.time() - demo.poll_interval
+        self.lost = [self.jobs.pop(name) for name, (_, _, created) in list(self.jobs.items())
+                     if name not in listed and created < cutoff]
+
+        pods = demo.core_client.list_namespaced_pod(
+                demo.namespace, field_selector='status.phase=Pending').items
+        self.unscheduled = sorted(set(
+            p.metadata.labels.get('job-name') for p in pods
+            if not p.spec.node_name and p.metadata.labels.get('job-name') in self.jobs))
+
+    def submit(self, work):
+        demo = self.demo
+        for name in self.stolen:
+            try:
+                demo._call(demo.batch_client.delete_namespaced_job, name, demo.namespace,
+                           propagation_policy='Background')
+            except ApiException as e:
+                if e.status != 404:
+                    raise
+        self.stolen = []
+        if not work:
+            return
+        demo._create_jobs(demo._group_manifest(group) for _, group in work)
+        now = time.time()
+        for cost, group in work:
+            self.jobs[group[0]['jobname']] = (cost, group, now)
+
+
+class Scheduler(object):
+    """Hands out the work of all clusters from one queue.
+
+    The job groups of every mapping entry are ordered by estimated cost,
+    largest first, and given to the clusters with the most free slots. Once
+    the queue is empty, jobs whose pods still wait for a node are moved from
+    their cluster to one with free slots, so a cluster that drains early
+    takes over the tail of a slower one."""
+
+    def __init__(self, demos, file_costs=None, poll_interval=10):
+        self.clusters = [Cluster(d) for d in demos]
+        self.poll_interval = poll_interval
+        self.costs = {}
+        if file_costs:
+            with open(file_costs, 'r') as f:
+                self.costs = json.load(f)
+        self.default_cost = 1.0
+        if self.costs:
+            self.default_cost = sum(self.costs.values()) / float(len(self.costs))
+        self._executor = futures.ThreadPoolExecutor(max_workers=len(self.clusters))
+
+    def _cost(self, group):
+        # costs are keyed by input file name, e.g. its size or event count
+        return sum(self.costs.get(os.path.basename(w['eventfile']), self.default_cost)
+                   for w in group)
+
+    def _queue(self):
+        # a single planner numbers the jobs of all clusters, so names and
+        # outputs stay unique wherever a job ends up
+        planner = self.clusters[0].demo
+        if planner.plan:
+            work = planner._remaining(planner.plan.work())
+        else:
+            work = planner._work([f for c in self.clusters for f in c.demo._dataset_files()])
+        work = [(self._cost(g), g) for g in planner._job_groups(work)]
+        work.sort(key=lambda w: w[0], reverse=True)
+        return collections.deque(work)
+
+    def _each(self, fn):
+        for r in [self._executor.submit(fn, c) for c in self.clusters]:
+            r.result()
+
+    def _assign(self, queue):
+        work = dict((c, []) for c in self.clusters)
+        for c in self.clusters:
+            for item in c.lost:
+                queue.appendleft(item[:2])
+            c.lost = []
+
+        free = dict((c, c.free()) for c in self.clusters)
+        while queue:
+            c = max(self.clusters, key=free.get)
+            if free[c] <= 0:
+                break
+            work[c].append(queue.popleft())
+            free[c] -= 1
+        if queue:
+            return work
+
+        for thief in sorted(self.clusters, key=free.get, reverse=True):
+            while free[thief] > 0:
+                victims = [c for c in self.clusters if c is not thief and c.unscheduled]
+                if not victims:
+                    return work
+                victim = max(victims, key=lambda c: len(c.unscheduled))
+                name = victim.unscheduled.pop()
+                cost, group, _ = victim.jobs.pop(name)
+                victim.stolen.append(name)
+                work[thief].append((cost, group))
+                free[thief] -= 1
+                log.info('moving %s from %s to %s', name, victim.demo.cluster,
+                         thief.demo.cluster)
+        return work
+
+    def run(self):
+        queue = self._queue()
+        total = sum(w[0] for w in queue)
+        log.info('scheduling %d jobs with a total cost of %.1f over %d clusters',
+                 len(queue), total, len(self.clusters))
+        if not queue:
+            return
+        for c in self.clusters:
+            c.pod_cpu = _pod_cpu(c.demo._group_manifest(queue[0][1])) or 1.0
+        self._each(lambda c: c.demo._create_configmaps())
+
+        start = time.time()
+        while True:
+            self._each(Cluster.refresh)
+            if not queue and not any(c.jobs or c.lost for c in self.clusters):
+                break
+            work = self._assign(queue)
+            self._each(lambda c: c.submit(work[c]))
+            log.info('%d jobs queued, %s', len(queue), ', '.join(
+                '%s %d/%d' % (c.demo.cluster, len(c.jobs), c.slots) for c in self.clusters))
+            time.sleep(self.poll_interval)
+
+        elapsed = time.time() - start
+        for c in self.clusters:
+            log.info('%s: %d jobs succeeded, %d failed, %.1f%% of the total cost',
+                     c.demo.cluster, c.succeeded, c.failed, 100.0 * c.cost / max(total, 1e-6))
+        log.info('all jobs done in %.0fs', elapsed)
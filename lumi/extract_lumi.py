@@ -6,6 +6,8 @@ import json
 import csv
 from collections import defaultdict
 
+from higgsdemo import lumi as lumi_index
+
 
 """
 Steps for each data set:
@@ -151,6 +153,9 @@ def main():
     global RUN_LUMI_DICT
 
     RUN_LUMI_DICT = get_run_lumi_dict()
+    # files with a lumi value already in this directory are not queried again
+    known = lumi_index.load(os.path.dirname(os.path.abspath(__file__)))
+    print(f'Found {len(known)} files with known lumi')
 
     datasets = ["/DoubleElectron/Run2011A-12Oct2013-v1/AOD",
                 "/DoubleElectron/Run2012B-22Jan2013-v1/AOD",
@@ -169,10 +174,13 @@ def main():
         # 3. Match the two file names (mind, S3 data name starts with s3/higgs-demo/eos/opendata/cms/)
         file_list_dict = get_file_list_dict(opendata_file_list, das_files)
         print(f'Found {len(file_list_dict)} matches with DAS files')
+        cached = {k: known.get(k) for k in file_list_dict if k in known}
+        file_list_dict = {k: v for k, v in file_list_dict.items() if k not in known}
         # 4. Query dasgoclient for the lumi section
         all_run_lumisections_dict = get_all_run_lumisections(file_list_dict)
         # 5. Sum up the lumi for each file
         file_lumi_dict = get_file_lumi_dict(all_run_lumisections_dict)
+        file_lumi_dict.update(cached)
         # 6. Cross-check that sum is OK
         print(sum(file_lumi_dict.values()))
         # 7. Write dictionary/JSON to disk
@@ -11,6 +11,11 @@ import matplotlib.lines as mlines
 import matplotlib.ticker as ticker
 from matplotlib.font_manager import FontProperties
 
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
+
 # Define some plot constants
 NBINS=37
 X_MIN=70
@@ -257,6 +262,14 @@ sampledata = {
     },
 }
 
+def set_nfiles(planfile):
+    # the number of files per sample of a run plan (higgs-demo plan)
+    with open(planfile) as f:
+        datasets = json.load(f)['datasets']
+    for sname, nfiles in datasets.items():
+        if sname in sampledata:
+            sampledata[sname]['nfiles'] = str(nfiles)
+
 colour_dict = {
     'higgs': 'red',
     'zz': cyan_m9,
@@ -266,52 +279,127 @@ colour_dict = {
 }
 
 
-plotdata = {
-    'samples': {},
-    'lumi_data': {
-        'mu_stream_2012': 0,
-        'mu_stream_2011': 0,
-        'el_stream_2012': 0,
-        'el_stream_2011': 0
-    }
-}
+# sample and channel ids, the indices of the sample store arrays
+samples = list(sampledata.keys())
+channels = []
+for sname in samples:
+    for pick in sampledata[sname]['pickup']:
+        if pick not in channels:
+            channels.append(pick)
+sample_ids = dict((sname, i) for i, sname in enumerate(samples))
+channel_ids = dict((pick, i) for i, pick in enumerate(channels))
+streams = ['mu_stream_2012', 'mu_stream_2011', 'el_stream_2012', 'el_stream_2011']
+stream_ids = dict((stream, i) for i, stream in enumerate(streams))
+pickup_ids = [np.asarray([channel_ids[pick] for pick in sampledata[sname]['pickup']])
+              for sname in samples]
+
+# the mc cross sections and the lumi stream weighting each mc sample channel
+xsecs = np.zeros(len(samples))
+is_mc = np.zeros(len(samples), dtype=bool)
+lumi_ids = np.zeros((len(samples), len(channels)), dtype=int)
+for sname, i in sample_ids.items():
+    if not 'cms_run' in sname:
+        is_mc[i] = True
+        xsecs[i] = sampledata[sname]['xsec']
+        for pick, j in channel_ids.items():
+            lumi_ids[i, j] = stream_ids[lumi_settings[sampledata[sname]['lumi']][pick]]
+
+
+class SampleStore(object):
+    """The histograms of a run summed per sample and channel in one
+    (samples, channels, NBINS) array, with the processed events and files
+    per sample and the lumi per stream. Its size does not depend on the
+    number of files added."""
+
+    def __init__(self):
+        self.counts = np.zeros((len(samples), len(channels), NBINS))
+        self.processed = np.zeros(len(samples))
+        self.files = np.zeros(len(samples), dtype=int)
+        self.lumi = np.zeros(len(streams))
+
+    @property
+    def lumi_data(self):
+        return dict((stream, self.lumi[i]) for stream, i in stream_ids.items())
+
+    def add(self, d):
+        if not 'samplename' in d: return
+        i = sample_ids.get(d['samplename'])
+        if i is None: return
+
+        pickups = sampledata[d['samplename']]['pickup']
+        self.counts[i, pickup_ids[i]] += np.asarray([d[pick] for pick in pickups], dtype=float)
+        self.processed[i] += d['processed']
+        self.files[i] += 1
+
+        if d.get('lumi'):
+            self.lumi[stream_ids[d['lumi']['stream']]] += d['lumi']['value']/1000000.0
+
+    def add_many(self, raws, chunk=500):
+        # json documents, grouped by sample and added with one sum per sample;
+        # decoded in chunks, holding all of them costs more in garbage
+        # collection than summing them does
+        added = 0
+        batch = []
+        for raw in raws:
+            batch.append(loads(raw))
+            if len(batch) >= chunk:
+                added += self._add_batch(batch)
+                batch = []
+        return added + self._add_batch(batch)
+
+    def _add_batch(self, docs):
+        by_sample = {}
+        lumi_streams, lumi_values = [], []
+        for d in docs:
+            i = sample_ids.get(d.get('samplename'))
+            if i is None: continue
+            by_sample.setdefault(i, []).append(d)
+            if d.get('lumi'):
+                lumi_streams.append(stream_ids[d['lumi']['stream']])
+                lumi_values.append(d['lumi']['value'])
+
+        added = 0
+        for i, group in by_sample.items():
+            pickups = sampledata[samples[i]]['pickup']
+            hists = np.asarray([[d[pick] for pick in pickups] for d in group], dtype=float)
+            self.counts[i, pickup_ids[i]] += hists.sum(axis=0)
+            self.processed[i] += sum(d['processed'] for d in group)
+            self.files[i] += len(group)
+            added += len(group)
+        np.add.at(self.lumi, np.asarray(lumi_streams, dtype=int),
+                  np.asarray(lumi_values)/1000000.0)
+        return added
+
+    def weights(self):
+        # mc is scaled by lumi * xsec / processed events, data is not
+        w = np.ones((len(samples), len(channels)))
+        mc = is_mc & (self.processed > 0)
+        w[mc] = (self.lumi[lumi_ids[mc]] * (xsecs[mc] / self.processed[mc])[:, np.newaxis])
+        return w
+
+    def weighted(self):
+        return self.counts * self.weights()[:, :, np.newaxis]
+
+    def weight_samples(self):
+        weighted = self.weighted()
+        weighted_and_summed = {}
+        for i in np.flatnonzero(self.files):
+            sname = samples[i]
+            for pick in sampledata[sname]['pickup']:
+                weighted_and_summed.setdefault(sname, {})[pick] = weighted[i, channel_ids[pick]]
+        return weighted_and_summed
+
+    def groups(self):
+        return group_samples(self.weight_samples())
+
+
+plotdata = SampleStore()
 
 def update(d):
-    if not 'samplename' in d: return
-    sname = d['samplename']
-    if not sname in sampledata: return
-
-    pickups = sampledata[sname]['pickup']
-
-    plotdata['samples'].setdefault(sname,{})
-    for pick in pickups:
-        plotdata['samples'][sname].setdefault(pick,[])
-        plotdata['samples'][sname][pick] += [d[pick]]
-
-    plotdata['samples'][sname].setdefault('processed',0)
-    plotdata['samples'][sname]['processed'] += d['processed']
-
-    if d.get('lumi'):
-        lumikey = d['lumi']['stream']
-        lumival = d['lumi']['value']
-        plotdata['lumi_data'][lumikey] += lumival/1000000.0
+    plotdata.add(d)
 
 def weight_samples(pd):
-    weighted_and_summed = {}
-    for sname,s in pd['samples'].items():
-        for p in sampledata[sname]['pickup']:
-            if not 'cms_run' in sname:
-                processed = s['processed']
-                lumikey = sampledata[sname]['lumi']
-                lumikey = lumi_settings[lumikey][p]
-                lumi = pd['lumi_data'][lumikey]
-                xsec = sampledata[sname]['xsec']
-                x = np.asarray(s[p]) / processed * lumi * xsec
-            else:
-                x = np.asarray(s[p])
-            summed = np.sum(x, axis=0)
-            weighted_and_summed.setdefault(sname,{})[p] = summed
-    return weighted_and_summed
+    return pd.weight_samples()
 
 
 def group_samples(weighted_and_summed):
@@ -342,17 +430,29 @@ def plot(ax,groups, hide = None):
     ax.set_xlim(70,181)
     ax.set_ylim(0,25)
 
+class Accumulator(SampleStore):
+    """A sample store updated with the documents not seen before only, so
+    that a refresh costs the same however many results the run already
+    has."""
+
+    def __init__(self):
+        super(Accumulator, self).__init__()
+        self.seen = set()
+
+    def update(self, items):
+        # (key, json document) pairs, e.g. the items of the redis data hash
+        new = []
+        for key, raw in items:
+            if key not in self.seen:
+                self.seen.add(key)
+                new.append(raw)
+        self.add_many(new)
+        return len(new)
+
+
 def reset_plotdata():
     global plotdata
-    plotdata = {
-        'samples': {},
-        'lumi_data': {
-            'mu_stream_2012': 0,
-            'mu_stream_2011': 0,
-            'el_stream_2012': 0,
-            'el_stream_2011': 0
-        }
-    }
+    plotdata = SampleStore()
 
 
 def init_mpl():
@@ -459,13 +559,17 @@ def add_legend(handles, ax):
     )
 
 
-def add_lumi(lumi_data, ax):
+def lumi_label(lumi_data):
     # Receiving a dict with the following keys: mu_stream_2012, mu_stream_2011, el_stream_2012, el_stream_2011
     lumi_2011 = 0.001*(max(lumi_data['mu_stream_2011'], lumi_data['el_stream_2011']))
     lumi_2012 = 0.001*(max(lumi_data['mu_stream_2012'], lumi_data['el_stream_2012']))
+    return r'%2.1f fb$^{\mathsf{-1}}$ (7 TeV), %2.1f fb$^{\mathsf{-1}}$ (8 TeV)' % (lumi_2011, lumi_2012)
+
+
+def add_lumi(lumi_data, ax):
     txt = ax.text(
     X_MIN+(X_MAX-X_MIN)*0.01, Y_MAX+0.025*DELTA_Y,
-    r'%2.1f fb$^{\mathsf{-1}}$ (7 TeV), %2.1f fb$^{\mathsf{-1}}$ (8 TeV)' % (lumi_2011, lumi_2012),
+    lumi_label(lumi_data),
     fontsize=29,
     horizontalalignment='left'
     )
@@ -485,15 +589,18 @@ def add_processed(lumi_data, ax):
     return txt
 
 
-def add_timestamp(ax):
+def timestamp():
     tz = pytz.timezone(os.environ.get('CMS_PLOT_TIMEZONE','Europe/Madrid'))
-    time_now = datetime.datetime.now(tz).time()
+    return datetime.datetime.now(tz).time().strftime('%H:%M:%S')
+
+
+def add_timestamp(ax):
     # cms_label = r'''\textbf{CMS} \textit{Open Data}'''
 
-    ax.text(
+    return ax.text(
         X_MIN-(X_MAX-X_MIN)*0.1, Y_MIN-(Y_MAX-Y_MIN)*0.11,
         # 0,0,
-        time_now.strftime('%H:%M:%S'),
+        timestamp(),
         fontsize=32
         )
 
@@ -509,10 +616,12 @@ def plot_cosmetics(ax, handles, lumidata):
     return txt
 
 
-def new_plot(ax, groups, handles, hide=None):
+def new_plot(ax, groups, handles, hide=None, lumi_data=None):
     hide = hide or []
     ax.clear()
-    txt = plot_cosmetics(ax, handles, plotdata['lumi_data'])
+    if lumi_data is None:
+        lumi_data = plotdata.lumi_data
+    txt = plot_cosmetics(ax, handles, lumi_data)
     bottom = np.zeros(NBINS)
     bottom_no_zz = np.zeros(NBINS)
     summed = np.zeros(NBINS)
@@ -547,6 +656,110 @@ def new_plot(ax, groups, handles, hide=None):
     return txt
 
 
+def step_xy(bottom, top):
+    # the outline of a stepfilled histogram from bottom to top
+    x = np.repeat(edges, 2)[1:-1]
+    return np.column_stack([
+        np.concatenate([x, x[::-1]]),
+        np.concatenate([np.repeat(top, 2), np.repeat(bottom, 2)[::-1]])
+    ])
+
+
+def set_errorbar(container, data, xerr=None, yerr=None):
+    line, caps, bars = container.lines
+    line.set_data(ctrs, data)
+    if yerr is not None:
+        bars[0].set_segments(np.stack([
+            np.column_stack([ctrs, data - yerr]), np.column_stack([ctrs, data + yerr])], axis=1))
+    if xerr is not None:
+        bars[0].set_segments(np.stack([
+            np.column_stack([ctrs - xerr, data]), np.column_stack([ctrs + xerr, data])], axis=1))
+
+
+class LivePlot(object):
+    """The plot of new_plot for refreshing in place: the axes, labels and
+    legend are drawn once and an update only sets the data of the retained
+    histograms, errorbars and texts. Where the canvas supports it, only
+    those are drawn again, over the saved background."""
+
+    def __init__(self, ax, handles):
+        self.ax = ax
+        self.figure = ax.figure
+        self.canvas = ax.figure.canvas
+        zeros = np.zeros(NBINS)
+
+        label_axes(ax)
+        add_cms_label(ax)
+        add_legend(handles, ax)
+        self.lumi_text = add_lumi(dict.fromkeys(streams, 0), ax)
+        self.time_text = add_timestamp(ax)
+
+        # in the order of new_plot, zz last so its lines stay on top
+        self.hists = {}
+        for group, facecolor, edgecolor in (('ttbar', gray, 'black'), ('dy', green_m5, 'black'),
+                                            ('higgs', 'white', 'red'), ('zz', cyan_m9, 'black')):
+            self.hists[group] = ax.add_patch(mpatches.Polygon(
+                step_xy(zeros, zeros), closed=True, facecolor=facecolor, edgecolor=edgecolor,
+                label=group, linewidth=HIST_LINEWIDTH, visible=False))
+        self.yerr = ax.errorbar(ctrs, zeros, yerr = zeros, marker = 'o', fmt='o', c = 'k')
+        self.xerr = ax.errorbar(ctrs, zeros, xerr = 1.5*np.ones_like(zeros), marker = 'o', fmt='o', c = 'k', markersize = 5, linewidth = 3, label = 'data')
+        format_axes(ax)
+
+        self.artists = list(self.hists.values()) + self.yerr.get_children() + \
+            self.xerr.get_children() + [self.lumi_text, self.time_text]
+        self.background = None
+        self.blit = getattr(self.canvas, 'supports_blit', False)
+        if self.blit:
+            for artist in self.artists:
+                artist.set_animated(True)
+            self.canvas.mpl_connect('draw_event', self._on_draw)
+
+    def _on_draw(self, event):
+        # a full draw leaves out the animated artists, save it without them
+        self.background = self.canvas.copy_from_bbox(self.figure.bbox)
+        self._draw_artists()
+
+    def _draw_artists(self):
+        for artist in self.artists:
+            self.figure.draw_artist(artist)
+
+    def update(self, groups, lumi_data, hide=None):
+        hide = hide or []
+        summed = dict((g, np.sum(groups[g], axis=0)) for g in groups if not g in hide)
+        bottom = np.zeros(NBINS)
+        bottom_no_zz = np.zeros(NBINS)
+        for group in ('ttbar', 'dy'):
+            if group in summed:
+                self.hists[group].set_xy(step_xy(bottom, bottom + summed[group]))
+                bottom = bottom + summed[group]
+                bottom_no_zz = bottom_no_zz + summed[group]
+        if 'zz' in summed:
+            bottom = bottom + summed['zz']
+            self.hists['zz'].set_xy(step_xy(bottom_no_zz, bottom_no_zz + summed['zz']))
+        if 'higgs' in summed:
+            self.hists['higgs'].set_xy(step_xy(bottom, bottom + summed['higgs']))
+        for group, hist in self.hists.items():
+            hist.set_visible(group in summed)
+
+        data = summed.get('data', np.zeros(NBINS))
+        set_errorbar(self.yerr, data, yerr = np.sqrt(data))
+        set_errorbar(self.xerr, data, xerr = 1.5*np.ones_like(data))
+        for artist in self.yerr.get_children() + self.xerr.get_children():
+            artist.set_visible('data' in summed)
+
+        self.lumi_text.set_text(lumi_label(lumi_data))
+        self.time_text.set_text(timestamp())
+        self.draw()
+
+    def draw(self):
+        if self.background is None:
+            self.canvas.draw_idle()
+            return
+        self.canvas.restore_region(self.background)
+        self._draw_artists()
+        self.canvas.blit(self.figure.bbox)
+
+
 def update_progress(ax, dict_files_processed):
     samples = list(sampledata[key]['id'] for key in sampledata.keys())
     y_pos = np.arange(len(samples))
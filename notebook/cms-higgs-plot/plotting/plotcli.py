@@ -18,7 +18,10 @@ import matplotlib.pyplot as plt
 @click.option('--datadir', default = 'testdata')
 @click.option('--groupsfile', default = 'groups.json')
 @click.option('--plotfile', default = 'plot.png')
-def make_plot(datadir,groupsfile,plotfile):
+@click.option('--plan', default = None)
+def make_plot(datadir,groupsfile,plotfile,plan):
+    if plan:
+        higgsplot.set_nfiles(plan)
     read_files = True
     dict_files_processed = {}
 
@@ -35,10 +38,8 @@ def make_plot(datadir,groupsfile,plotfile):
 
         print(len(files),'files')
 
-        data = [json.load(open(f)) for f in files]
         higgsplot.reset_plotdata()
-        for d in data:
-            higgsplot.update(d)
+        higgsplot.plotdata.add_many(open(f, 'rb').read() for f in files)
 
         start = time.time()
         weighted_and_summed = higgsplot.weight_samples(higgsplot.plotdata)
@@ -8,8 +8,13 @@ import numpy as np
 import time
 
 testdata  = {}
+accumulator = hp.Accumulator()
+# the id of the last stream entry read, None until the hash was read once
+cursor = None
 
 def setup_figure():
+    if os.environ.get('CMS_PLOT_PLAN'):
+        hp.set_nfiles(os.environ['CMS_PLOT_PLAN'])
     hp.init_mpl()
     handles = hp.get_legend_handles()
 
@@ -20,31 +25,30 @@ def setup_figure():
         edgecolor='k', dpi = 40
     )
     fig.canvas.layout.width = '500px'
-    figure = fig, ax, None, handles
+    figure = fig, ax, None, handles, hp.LivePlot(ax, handles)
     update_plot(figure,[])
     return figure
 
-def update_plotdata(jsondocs):
-    hp.reset_plotdata()
-    for x in jsondocs:
-        hp.update(json.loads(x))
-    weighted_and_summed = hp.weight_samples(hp.plotdata)
-    groups = hp.group_samples(weighted_and_summed)
-    return groups
+def update_plotdata(items):
+    # only the documents not seen yet are parsed and added
+    accumulator.update(items)
+    return accumulator.groups()
 
-def update_plot(figure,jsondocs):
-    fig, ax, ax_right, handles = figure
-    ax.clear()
-    groups = update_plotdata(jsondocs)
-    hp.new_plot(ax, groups, handles)
-    fig.canvas.draw()
+def update_plot(figure,items):
+    fig, ax, ax_right, handles, plot = figure
+    groups = update_plotdata(items)
+    plot.update(groups, accumulator.lumi_data)
 
 def reset_data(source = None):
+    global accumulator
+    accumulator = hp.Accumulator()
     source = source or os.environ.get('CMS_PLOT_SOURCE','disk:testdata.json')
     if 'redis' in source:
+        global cursor
         _, key = source.split(':')
         r = redis.StrictRedis(host = os.environ['REDIS_HOST'])
-        r.delete(key)
+        r.delete(key, key + ':stream')
+        cursor = None
     if 'testing' in source:
         global testdata
         global testindex
@@ -53,17 +57,39 @@ def reset_data(source = None):
         testdata  = dict([items[idx] for idx in indices])
         time.sleep(os.environ.get('CMS_TESTING_SLEEP',100))
 
+def read_stream(r, key, block = None):
+    # the results published since the last call, read from the stream key:stream
+    # written next to the hash, waiting up to block ms for new ones
+    global cursor
+    stream = key + ':stream'
+    if cursor is None:
+        # results older than the stream are only in the hash, the ones
+        # published meanwhile come twice and the accumulator skips them
+        last = r.xrevrange(stream, count = 1)
+        cursor = last[0][0] if last else '0'
+        return r.hgetall(key).items()
+    if block is None:
+        block = int(os.environ.get('CMS_PLOT_BLOCK_MS', 5000))
+    keys = []
+    for _, entries in r.xread({stream: cursor}, block = block) or []:
+        for entry_id, fields in entries:
+            keys.append(fields[b'key'])
+            cursor = entry_id
+    if not keys:
+        return []
+    return [(k, v) for k, v in zip(keys, r.hmget(key, keys)) if v is not None]
+
 def load_data(source = None):
     source = source or os.environ.get('CMS_PLOT_SOURCE','disk:testdata.json')
     if 'disk' in source:
         #e.g. disk:myfile.json
         _, fname = source.split(':')
-        return json.load(open(fname)).values()
+        return json.load(open(fname)).items()
     if 'redis' in source:
-        #e.g. disk:myrediskey
+        #e.g. redis:myrediskey
         r = redis.StrictRedis(host = os.environ['REDIS_HOST'])
         _, key = source.split(':')
-        return r.hgetall(key).values()
+        return read_stream(r, key)
     if 'testing'in source:
         global testdata
         data = json.load(open('testdata.json'))
@@ -71,11 +97,11 @@ def load_data(source = None):
         items = list(data.items())
         remaining_indices = [i for i,(k,v) in enumerate(items) if k not in testdata]
         if not remaining_indices:
-            return testdata.values()
+            return testdata.items()
 
         indices = list(np.random.choice(remaining_indices, replace = False, size = min(20,len(remaining_indices))))
 
         for index in indices:
             k,v = items[index]
             testdata[k] = v
-        return testdata.values()
+        return testdata.items()
@@ -64,7 +64,9 @@ setup(
         'higgs.demo': [
             'cleanup = higgsdemo.cmd:Cleanup',
             'notebook = higgsdemo.cmd:Notebook',
+            'plan = higgsdemo.cmd:Plan',
             'prepare = higgsdemo.cmd:Prepare',
+            'retry = higgsdemo.cmd:Retry',
             'submit = higgsdemo.cmd:Submit',
             'watch = higgsdemo.cmd:Watch',
             'clusters-create = higgsdemo.cmd:ClustersCreate',
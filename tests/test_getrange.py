@@ -0,0 +1,169 @@
+"""getrange.py, the input download of the job pods, against a local MinIO.
+
+Uses the server at MINIO_ENDPOINT (with MINIO_ACCESS_KEY and MINIO_SECRET_KEY)
+if set, or starts one from a minio binary on the PATH, and skips otherwise."""
+import hashlib
+import importlib.util
+import os
+import shutil
+import socket
+import subprocess
+import threading
+import time
+
+import pytest
+import yaml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUCKET = 'higgs-demo-test'
+
+
+def _getrange(tmpdir):
+    with open(os.path.join(ROOT, 'cm-runjob.yaml')) as f:
+        for doc in yaml.safe_load_all(f):
+            if 'getfile.sh' in doc.get('data', {}):
+                script = doc['data']['getfile.sh']
+    source = script.split("cat <<'EOF' > /getrange.py\n", 1)[1].split('\nEOF\n', 1)[0]
+    path = os.path.join(str(tmpdir), 'getrange.py')
+    with open(path, 'w') as f:
+        f.write(source)
+    spec = importlib.util.spec_from_file_location('getrange', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _wait(endpoint, timeout=30):
+    host, port = endpoint.split('://', 1)[1].split(':')
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, int(port)), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.2)
+    raise RuntimeError('minio did not start on %s' % endpoint)
+
+
+@pytest.fixture(scope='module')
+def minio(tmp_path_factory):
+    if os.environ.get('MINIO_ENDPOINT'):
+        yield (os.environ['MINIO_ENDPOINT'], os.environ.get('MINIO_ACCESS_KEY', 'minioadmin'),
+               os.environ.get('MINIO_SECRET_KEY', 'minioadmin'))
+        return
+    binary = shutil.which('minio')
+    if not binary:
+        pytest.skip('no MINIO_ENDPOINT set and no minio binary on the PATH')
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    env = dict(os.environ, MINIO_ROOT_USER='higgsdemo', MINIO_ROOT_PASSWORD='higgsdemo-secret')
+    proc = subprocess.Popen([binary, 'server', str(tmp_path_factory.mktemp('minio')),
+                             '--address', '127.0.0.1:%d' % port],
+                            env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        endpoint = 'http://127.0.0.1:%d' % port
+        _wait(endpoint)
+        yield endpoint, 'higgsdemo', 'higgsdemo-secret'
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+@pytest.fixture(scope='module')
+def objects(minio):
+    boto3 = pytest.importorskip('boto3')
+    endpoint, access, secret = minio
+    s3 = boto3.client('s3', endpoint_url=endpoint, aws_access_key_id=access,
+                      aws_secret_access_key=secret, region_name='us-east-1')
+    try:
+        s3.create_bucket(Bucket=BUCKET)
+    except s3.exceptions.BucketAlreadyOwnedByYou:
+        pass
+    data = {'input/large.root': os.urandom(5 * 1024 * 1024 + 123),
+            'input/small.root': os.urandom(2 * 1024 * 1024)}
+    for key, body in data.items():
+        s3.put_object(Bucket=BUCKET, Key=key, Body=body)
+    return data
+
+
+@pytest.fixture
+def getrange(minio, tmpdir, monkeypatch):
+    endpoint, access, secret = minio
+    for name in ('GCS_HOST', 'GCS_ACCESS', 'GCS_SECRET', 'INPUT_CACHE'):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv('S3_HOST', endpoint)
+    monkeypatch.setenv('S3_ACCESS', access)
+    monkeypatch.setenv('S3_SECRET', secret)
+    monkeypatch.setenv('STORAGE_REGION', 'us-east-1')
+    module = _getrange(tmpdir)
+    module.PIECE = 1024 * 1024
+    module.BLOCK = 64 * 1024
+    return module
+
+
+def test_ranged_parallel_download(getrange, objects, tmpdir, monkeypatch):
+    monkeypatch.setenv('DOWNLOAD_THREADS', '4')
+    monkeypatch.setenv('DOWNLOAD_MAX_KB', '0')
+    ranges, threads = [], set()
+    get = getrange.get
+
+    def recording_get(url, start, end, headers=None):
+        ranges.append((start, end))
+        threads.add(threading.current_thread().name)
+        return get(url, start, end, headers)
+    monkeypatch.setattr(getrange, 'get', recording_get)
+
+    dest = str(tmpdir.join('large.root'))
+    getrange.main('s3/%s/input/large.root' % BUCKET, dest)
+
+    body = objects['input/large.root']
+    with open(dest, 'rb') as f:
+        assert hashlib.sha256(f.read()).digest() == hashlib.sha256(body).digest()
+    # the size probe and then the six pieces, over several threads
+    assert ranges[0] == (0, 0)
+    assert sorted(ranges[1:]) == [(s, min(s + getrange.PIECE, len(body)) - 1)
+                                  for s in range(0, len(body), getrange.PIECE)]
+    assert len(threads) > 2
+
+
+def test_size(getrange, objects):
+    url, headers = getrange.object_url('s3/%s/input/large.root' % BUCKET)
+    assert getrange.stat(url, headers)[0] == len(objects['input/large.root'])
+
+
+def test_max_kb_caps_all_threads(getrange, objects, tmpdir, monkeypatch):
+    monkeypatch.setenv('DOWNLOAD_THREADS', '8')
+    monkeypatch.setenv('DOWNLOAD_MAX_KB', '2048')
+    size = len(objects['input/small.root'])
+
+    start = time.time()
+    getrange.main('s3/%s/input/small.root' % BUCKET, str(tmpdir.join('small.root')))
+    elapsed = time.time() - start
+
+    # 2mb at 2mb/s over all threads, less the first block which goes through
+    # without waiting
+    assert elapsed >= (size - getrange.BLOCK) / (2048 * 1024.0) * 0.95
+    assert os.path.getsize(str(tmpdir.join('small.root'))) == size
+
+
+def test_cache_entry_evicted_while_copied(tmpdir, monkeypatch):
+    getrange = _getrange(tmpdir)
+    cache = getrange.Cache(str(tmpdir.join('cache')), 1)
+    entry = cache.entry('s3/bucket/input.root', 'etag', 4)
+    dest = str(tmpdir.join('input.root'))
+    assert not cache.get(entry, 4, dest)
+
+    with open(entry, 'wb') as f:
+        f.write(b'data')
+    copyfileobj = getrange.shutil.copyfileobj
+
+    def evicting_copy(src, out, length):
+        os.remove(entry)
+        copyfileobj(src, out, length)
+    monkeypatch.setattr(getrange.shutil, 'copyfileobj', evicting_copy)
+    assert cache.get(entry, 4, dest)
+    with open(dest, 'rb') as f:
+        assert f.read() == b'data'
+    assert not cache.get(entry, 4, dest)
@@ -0,0 +1,106 @@
+"""The notebook following the results of a run: the publisher of runjob.sh
+writing to the redis data hash and stream, and plotnb.read_stream reading
+the hash once and then the stream from where the hash read left off."""
+import contextlib
+import io
+import json
+import os
+import sys
+
+import pytest
+import yaml
+
+fakeredis = pytest.importorskip('fakeredis')
+redis = pytest.importorskip('redis')
+pytest.importorskip('matplotlib')
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, 'notebook', 'cms-higgs-plot'))
+
+import plotting.higgsplot as hp
+import plotting.plotnb as nb
+
+
+def _publisher():
+    with open(os.path.join(ROOT, 'cm-runjob.yaml')) as f:
+        for doc in yaml.safe_load_all(f):
+            if 'runjob.sh' in doc.get('data', {}):
+                script = doc['data']['runjob.sh']
+    source = script.split('cat <<EOF > /publish_single.py\n', 1)[1].split('\nEOF\n', 1)[0]
+    return compile(source, 'publish_single.py', 'exec')
+
+
+def _document(i):
+    name = hp.samples[i % len(hp.samples)]
+    d = {'samplename': name, 'processed': 100}
+    for pick in hp.sampledata[name]['pickup']:
+        d[pick] = [1.0] * hp.NBINS
+    return d
+
+
+@pytest.fixture
+def server(monkeypatch, tmpdir):
+    server = fakeredis.FakeServer()
+
+    class Redis(fakeredis.FakeStrictRedis):
+        def __init__(self, host=None, **kwargs):
+            super(Redis, self).__init__(server=server)
+
+    monkeypatch.setattr(redis, 'Redis', Redis)
+    monkeypatch.setattr(redis, 'StrictRedis', Redis)
+    monkeypatch.setattr(nb, 'cursor', None)
+    monkeypatch.setattr(nb, 'accumulator', hp.Accumulator())
+    monkeypatch.setenv('REDIS_HOST', 'redis')
+    monkeypatch.setenv('CMS_LUMINOSITY_DATA', 'null')
+    code = _publisher()
+
+    def publish(i):
+        filename = str(tmpdir.join('output-%d.json' % i))
+        with open(filename, 'w') as f:
+            json.dump(_document(i), f)
+        monkeypatch.setattr(sys, 'argv', ['publish_single.py', filename])
+        with contextlib.redirect_stdout(io.StringIO()):
+            exec(code, {'__name__': '__main__'})
+        return filename.encode('utf-8')
+
+    Redis.publish = staticmethod(publish)
+    return Redis()
+
+
+def test_stream_holds_keys_only(server):
+    key = server.publish(0)
+    [(_, fields)] = server.xrange('data:stream')
+    assert fields == {b'key': key}
+    assert json.loads(server.hget('data', key))['samplename'] == hp.samples[0]
+
+
+def test_cursor_handoff_and_dedup(server, monkeypatch):
+    # results from before the stream are only in the hash
+    for i in range(3):
+        server.hset('data', 'old-%d' % i, json.dumps(_document(i)))
+    published = [server.publish(i) for i in range(3, 5)]
+
+    # a result published between the stream position and the hash read is
+    # in both
+    hgetall = server.hgetall
+    late = []
+
+    def racing_hgetall(key):
+        late.append(server.publish(5))
+        return hgetall(key)
+    monkeypatch.setattr(server, 'hgetall', racing_hgetall)
+
+    first = nb.read_stream(server, 'data')
+    monkeypatch.setattr(server, 'hgetall', hgetall)
+    assert len(first) == 6
+    assert nb.accumulator.update(first) == 6
+
+    published += [server.publish(i) for i in range(6, 8)]
+    items = nb.read_stream(server, 'data', block=10)
+    assert [k for k, _ in items] == late + published[2:]
+    # the late result comes again from the stream and is skipped
+    assert nb.accumulator.update(items) == 2
+    assert nb.accumulator.files.sum() == 8
+
+    assert nb.read_stream(server, 'data', block=10) == []
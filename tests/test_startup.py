@@ -0,0 +1,100 @@
+"""Startup cost of the cli: importing higgsdemo.cmd, which every command and
+--help does, must not load the heavy dependencies only some commands use."""
+import ast
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('cliff')
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# cumulative import time of higgsdemo.cmd, about 100-150ms with the
+# requirements installed, 550ms and more when they were imported eagerly
+IMPORT_BUDGET_MS = 300
+
+HEAVY = ('kubernetes', 'jupyterlab', 'google.cloud', 'joblib')
+
+# the modules importing kubernetes at module level
+KUBERNETES_MODULES = ('higgsdemo.scheduler', 'higgsdemo.retry', 'higgsdemo.informer')
+
+
+def _python(*args):
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(
+        [ROOT] + [p for p in [os.environ.get('PYTHONPATH')] if p]))
+    return subprocess.run([sys.executable] + list(args), cwd=ROOT, env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                          universal_newlines=True, check=True)
+
+
+def test_import_time_budget():
+    stderr = _python('-X', 'importtime', '-c', 'import higgsdemo.cmd').stderr
+    cumulative = None
+    for line in stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == 'higgsdemo.cmd':
+            cumulative = int(fields[1])
+    assert cumulative is not None, stderr
+    assert cumulative / 1000.0 < IMPORT_BUDGET_MS
+
+
+def test_heavy_modules_not_loaded():
+    out = _python('-c', 'import json, sys; import higgsdemo.cmd; '
+                        'print(json.dumps(sorted(sys.modules)))').stdout
+    modules = json.loads(out)
+    loaded = [m for m in modules
+              if any(m == h or m.startswith(h + '.') for h in HEAVY + KUBERNETES_MODULES)]
+    assert loaded == []
+
+
+def _imports(path, toplevel):
+    """The modules imported by a file, at module level or in functions."""
+    with open(path) as f:
+        tree = ast.parse(f.read(), path)
+    found = set()
+
+    def visit(node, in_function):
+        for child in ast.iter_child_nodes(node):
+            nested = in_function or isinstance(
+                child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.Lambda))
+            if isinstance(child, ast.Import) and nested != toplevel:
+                found.update(a.name for a in child.names)
+            elif isinstance(child, ast.ImportFrom) and nested != toplevel and child.module:
+                found.add(child.module)
+                found.update('%s.%s' % (child.module, a.name) for a in child.names)
+            visit(child, nested)
+    visit(tree, False)
+    return found
+
+
+def _package_modules():
+    package = os.path.join(ROOT, 'higgsdemo')
+    return dict(('higgsdemo.%s' % name[:-3], os.path.join(package, name))
+                for name in os.listdir(package) if name.endswith('.py'))
+
+
+def test_kubernetes_modules_only_imported_lazily():
+    modules = _package_modules()
+    for name in KUBERNETES_MODULES:
+        assert 'kubernetes' in [m.split('.')[0] for m in _imports(modules[name], True)]
+
+    # nothing imported with higgsdemo.cmd imports them at module level
+    seen, todo = set(), ['higgsdemo.cmd']
+    while todo:
+        name = todo.pop()
+        if name in seen or name not in modules:
+            continue
+        seen.add(name)
+        imported = _imports(modules[name], True)
+        assert not imported & set(KUBERNETES_MODULES), name
+        todo.extend(imported)
+
+    # and the commands using them do so where they need them
+    lazy = set()
+    for name in seen:
+        lazy |= _imports(modules[name], False)
+    assert set(KUBERNETES_MODULES) <= lazy